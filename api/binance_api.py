@@ -1,18 +1,22 @@
 from .default_api import DefaultAPI, WebSocketAPI
+from .rate_governor import RateGovernor
 from config import config
 from urllib.parse import urlencode
 from general import Product
+import general
 
 
 from collections import namedtuple
-import datetime
+import bisect
+import collections
+import functools
 import json
 import pprint
 import logging
+import time
 
 from urllib.parse import urlencode
 import asyncio
-import aiohttp
 
 
 import hmac
@@ -21,18 +25,67 @@ import base64
 
 
 class Util:
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_hmac(key):
+        # Keyed once per secret, callers must update a copy
+        return hmac.new(key.encode('utf-8'), digestmod=hashlib.sha256)
+
+
+    @classmethod
+    def get_timestamp(cls):
+        return str(int(time.time() * 1000))
+
+
     @classmethod
     def get_signature(cls, query, key):
         msg = urlencode(query)
-        key = key.encode('utf-8')
-        signature = hmac.new(key, msg.encode("utf-8"), hashlib.sha256)
+        signature = cls.get_hmac(key).copy()
+        signature.update(msg.encode("utf-8"))
         return signature.hexdigest()
 
 
+class OrderTemplate:
+    # Signed order request prepared while the order is armed. The static
+    # part of the query is already fed into the HMAC, rendering only
+    # appends the timestamp and takes the digest.
+
+    def __init__(self, url, query, order_type, keyed_hmac):
+        self.url = url
+        self.order_type = order_type
+        self._query = f'{query}&timestamp='
+        self._hmac = keyed_hmac.copy()
+        self._hmac.update(self._query.encode('utf-8'))
+
+
+    def render(self, timestamp):
+        signature = self._hmac.copy()
+        signature.update(timestamp.encode('utf-8'))
+        return f'{self._query}{timestamp}&signature={signature.hexdigest()}'
+
+
 class BinanceREST_API(DefaultAPI):
     api_url = 'api.binance.com'
     ws_url = 'wss://stream.binance.com:9443/stream'
     account_group = None
+    warmup_url = 'https://api.binance.com/api/v3/ping'
+    rate_limits = {
+        'weight:1m': (1200, 60),
+        'orders:10s': (100, 10),
+        'orders:1d': (200000, 86400),
+    }
+    endpoint_costs = {
+        None: {'weight:1m': 1},
+        ('get', '/exchangeInfo'): {'weight:1m': 10},
+        ('get', '/ticker/price'): {'weight:1m': 2},
+        ('get', '/ticker/bookTicker'): {'weight:1m': 2},
+        ('post', '/order'): {'weight:1m': 1, 'orders:10s': 1, 'orders:1d': 1},
+    }
+    # X-MBX-USED-WEIGHT-1M updates 'weight:1m' and so on
+    usage_headers = {
+        'x-mbx-used-weight-': 'weight',
+        'x-mbx-order-count-': 'orders',
+    }
     ws_path = '/stream'
     connection_num = 1
 
@@ -51,7 +104,9 @@ class BinanceREST_API(DefaultAPI):
         headers = {
             'X-MBX-APIKEY': self.api_token,
         }
-        session = aiohttp.ClientSession(headers=headers)
+        session = self.connection_pool.create_session(
+            headers=headers, json_serialize=general.json_dumps
+        )
         self.session = session
 
 
@@ -74,14 +129,14 @@ class BinanceREST_API(DefaultAPI):
         return self.ws_url
 
 
-    async def connect_ws(self, url=None, connection_num=None):
+    async def connect_ws(self, url=None, connection_num=None, **kwargs):
         if not url:
             url = await self.get_ws_url(
                 group_needed=True
             )
         if not connection_num:
             connection_num = self.connection_num
-        return BinanceWebSocket(url, self, connection_num=self.connection_num)
+        return BinanceWebSocket(url, self, connection_num=connection_num, **kwargs)
 
 
     async def connect_to_orders_ws(self):
@@ -135,8 +190,7 @@ class BinanceREST_API(DefaultAPI):
 
 
     async def get_params(self, path, *args, **kwargs):
-        timestamp = int(datetime.datetime.now().timestamp() * 1000)
-        timestamp = str(timestamp)
+        timestamp = Util.get_timestamp()
 
         params = kwargs.get('params', {})
         time_needed = kwargs.get('time_needed', True)
@@ -158,7 +212,7 @@ class BinanceREST_API(DefaultAPI):
         return params
 
 
-    async def place_order(
+    def prepare_order(
             self,
             symbol,
             size,
@@ -176,14 +230,47 @@ class BinanceREST_API(DefaultAPI):
         }
         if order_type == 'LIMIT':
             data['price'] = str(price)
-        path = '/order'
-        resp = await self.post(
-            path=path, params=data, api_type='api', signature_needed=True, time_needed=True
+        url = f'https://{self.api_url}/api/v3/order'
+        return OrderTemplate(
+            url, urlencode(data), order_type, Util.get_hmac(self._secret)
+        )
+
+
+    async def place_prepared_order(self, template):
+        await self.governor.acquire('post', '/order', RateGovernor.HIGH)
+        body = template.render(Util.get_timestamp())
+        response = await self.session.post(
+            template.url,
+            data=body,
+            headers={
+                'Content-Type': 'application/x-www-form-urlencoded',
+            },
+        )
+        self.governor.update(response)
+        return await response.json(loads=general.json_loads)
+
+
+    async def place_order(
+            self,
+            symbol,
+            size,
+            order_type,
+            order_side,
+            price=None,
+            time_in_force='GTC',
+    ):
+        template = self.prepare_order(
+            symbol=symbol,
+            size=size,
+            order_type=order_type,
+            order_side=order_side,
+            price=price,
+            time_in_force=time_in_force,
         )
-        return resp
+        return await self.place_prepared_order(template)
 
 
-    async def get_rate(self, symbol=None):
+    async def get_rate(self, symbol=None, priority=RateGovernor.LOW):
         params = {
             'symbol': symbol
         } if symbol else None
@@ -192,34 +279,178 @@ class BinanceREST_API(DefaultAPI):
             api_type='api',
             time_needed=False,
             signature_needed=False,
-            params=params
+            params=params,
+            priority=priority,
         )
         price = result['price']
         return price
 
 
-class BinanceWebSocket(WebSocketAPI):
+    async def get_mid_price(self, symbol, priority=RateGovernor.LOW):
+        # Midpoint of the best bid and ask, the price the streams report
+        result = await self.get(
+            path='/ticker/bookTicker',
+            api_type='api',
+            time_needed=False,
+            signature_needed=False,
+            params={'symbol': symbol},
+            priority=priority,
+        )
+        return (float(result['bidPrice']) + float(result['askPrice'])) / 2
 
-    async def subscribe_to_channels(self, channels, index=None, id=1):
-        if not index:
-            index = 0
+
+class BinanceWebSocket(WebSocketAPI):
+    # Streams are spread over ws_pool with a consistent hash ring. A stream
+    # stays on its connection until unsubscribed, a full connection passes
+    # new streams on to the next one on the ring and a new connection is
+    # opened when all of them are full.
+
+    STREAM_PREFIX = '{"stream":"'
+    MAX_STREAMS = 1024
+    MAX_MESSAGES_PER_SECOND = 5
+    VIRTUAL_NODES = 64
+    reconnect_in_place = True
+
+    def __init__(
+        self,
+        *args,
+        max_streams=MAX_STREAMS,
+        max_messages_per_second=MAX_MESSAGES_PER_SECOND,
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self._max_streams = max_streams
+        self._max_messages_per_second = max_messages_per_second
+        self._reset_shards()
+
+    async def __aenter__(self):
+        await super().__aenter__()
+        self._reset_shards()
+        for index in range(len(self.ws_pool)):
+            self._add_shard(index)
+
+    def _reset_shards(self):
+        self._ring = []
+        self._shards = {}
+        self._assignments = {}
+        self._sent = {}
+        self._send_locks = {}
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:8], 16)
+
+    def _add_shard(self, index):
+        self._shards[index] = set()
+        for node in range(self.VIRTUAL_NODES):
+            bisect.insort(self._ring, (self._hash(f'{index}:{node}'), index))
+
+    def _assign(self, channel):
+        index = self._assignments.get(channel)
+        if index is not None:
+            return index
+        start = bisect.bisect(self._ring, (self._hash(channel),))
+        checked = set()
+        for i in range(len(self._ring)):
+            index = self._ring[(start + i) % len(self._ring)][1]
+            if index in checked:
+                continue
+            checked.add(index)
+            if len(self._shards[index]) < self._max_streams:
+                self._shards[index].add(channel)
+                self._assignments[channel] = index
+                return index
+            if len(checked) == len(self._shards):
+                break
+        return None
+
+    async def add_connection(self):
+        index = await super().add_connection()
+        self._add_shard(index)
+        self._logger.info(f'Opened stream connection {index}')
+        return index
+
+    async def on_reconnect(self, index):
+        self._sent.pop(index, None)
+        channels = list(self._shards.get(index, ()))
+        if channels:
+            await self._send_channels('SUBSCRIBE', channels, index)
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats['streams'] = {
+            index: len(channels) for index, channels in self._shards.items()
+        }
+        return stats
+
+    async def send_json(self, index, data):
+        # Binance drops connections that send more than
+        # MAX_MESSAGES_PER_SECOND messages
+        lock = self._send_locks.setdefault(index, asyncio.Lock())
+        async with lock:
+            sent = self._sent.setdefault(index, collections.deque())
+            now = time.monotonic()
+            while sent and now - sent[0] >= 1:
+                sent.popleft()
+            if len(sent) >= self._max_messages_per_second:
+                await asyncio.sleep(1 - (now - sent[0]))
+                sent.popleft()
+            sent.append(time.monotonic())
+            await super().send_json(index, data)
+
+    def get_route_keys(self, data):
+        stream = data.get('stream')
+        if not stream:
+            return ()
+        return (stream, stream.partition('@')[2])
+
+    def peek_route_keys(self, raw):
+        if not raw.startswith(self.STREAM_PREFIX):
+            return None
+        start = len(self.STREAM_PREFIX)
+        end = raw.find('"', start)
+        if end == -1:
+            return None
+        stream = raw[start:end]
+        return (stream, stream.partition('@')[2])
+
+    async def _send_channels(self, method, channels, index, id=1):
         await self.send_json(index=index, data={
-                "method": "SUBSCRIBE",
+                "method": method,
                 "params": channels,
                 "id": id
         })
 
+    async def subscribe_to_channels(self, channels, index=None, id=1):
+        if index is not None:
+            await self._send_channels('SUBSCRIBE', channels, index, id=id)
+            return None
+        by_index = collections.defaultdict(list)
+        for channel in channels:
+            index = self._assign(channel)
+            if index is None:
+                await self.add_connection()
+                index = self._assign(channel)
+            by_index[index].append(channel)
+        for index, index_channels in by_index.items():
+            await self._send_channels('SUBSCRIBE', index_channels, index, id=id)
+
     async def subscribe_to_channel(self, channel, index=None, id=1):
         await self.subscribe_to_channels([channel], index=index, id=id)
 
     async def unsubscribe_from_channels(self, channels, index=None, id=1):
-        if not index:
-            index = 0
-        await self.send_json(index=index, data={
-                "method": "UNSUBSCRIBE",
-                "params": channels,
-                "id": id
-        })
+        if index is not None:
+            await self._send_channels('UNSUBSCRIBE', channels, index, id=id)
+            return None
+        by_index = collections.defaultdict(list)
+        for channel in channels:
+            index = self._assignments.pop(channel, None)
+            if index is None:
+                continue
+            self._shards[index].discard(channel)
+            by_index[index].append(channel)
+        for index, index_channels in by_index.items():
+            await self._send_channels('UNSUBSCRIBE', index_channels, index, id=id)
 
 
 if __name__ == '__main__':
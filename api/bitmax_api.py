@@ -1,17 +1,20 @@
-from .default_api import DefaultAPI, WebSocketAPI, Dispatcher
+from .default_api import DefaultAPI, WebSocketAPI
+from .rate_governor import RateGovernor
 from config import config
 from general import Product
+import general
 
 
 from collections import namedtuple
-import datetime
+import functools
 import json
+import re
+import time
 import pprint
 import logging
 
 
 import asyncio
-import aiohttp
 
 
 import hmac
@@ -20,41 +23,96 @@ import base64
 
 
 class Util:
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_hmac(key):
+        # The secret is decoded and keyed once, callers must update a copy
+        return hmac.new(base64.b64decode(key), digestmod=hashlib.sha256)
+
+
+    @classmethod
+    def get_timestamp(cls):
+        return str(int(time.time() * 1000))
+
+
+    @classmethod
+    def sign(cls, keyed_hmac, timestamp, path):
+        signature = keyed_hmac.copy()
+        signature.update(f'{timestamp}+{path}'.encode('utf-8'))
+        return base64.b64encode(signature.digest()).decode("utf-8")
+
+
     @classmethod
-    def get_signature(cls, path, key):
-        timestamp = int(datetime.datetime.now().timestamp() * 1000)
-        timestamp = str(timestamp)
+    def get_signature(cls, path, key, timestamp=None):
+        if not timestamp:
+            timestamp = cls.get_timestamp()
 
         path = path.split('/')
         path = path[-1] if path else ''
-        msg = f'{timestamp}+{path}'
-        msg = bytearray(msg.encode("utf-8"))
-        hmac_key = base64.b64decode(key)
-        signature = hmac.new(hmac_key, msg, hashlib.sha256)
-        signature = base64.b64encode(signature.digest()).decode("utf-8")
-        return signature
+        return cls.sign(cls.get_hmac(key), timestamp, path)
 
 
     @classmethod
     def make_headers(cls, path, api_token, secret):
-        timestamp = int(datetime.datetime.now().timestamp() * 1000)
+        timestamp = cls.get_timestamp()
         headers = {
-            'x-auth-timestamp': str(timestamp),
-            "x-auth-signature": cls.get_signature(path, secret),
+            'x-auth-timestamp': timestamp,
+            "x-auth-signature": cls.get_signature(path, secret, timestamp),
         }
         return headers
 
 
+    @staticmethod
+    def get_mid_price(rate):
+        # /ticker rows carry [price, size] of the best bid and ask, a ticker
+        # with an empty side of the book only has its last price
+        if rate.get('bid') and rate.get('ask'):
+            return (float(rate['bid'][0]) + float(rate['ask'][0])) / 2
+        return float(rate['close'])
+
+
     @classmethod
     def gen_server_order_id(user_uid, cl_order_id, ts, order_src='s'):
         return (order_src + format(ts, 'x')[-11:] + user_uid[-11:] + cl_order_id[-9:])[:32]
 
 
+class OrderTemplate:
+    # Order request prepared while the order is armed, rendering only
+    # stamps the time into the body and signs it with the pre-keyed HMAC
+
+    def __init__(self, url, data, order_type, keyed_hmac):
+        self.url = url
+        self.order_type = order_type
+        self._path = url.split('/')[-1]
+        self._body = general.json_dumps(data)[1:]
+        self._hmac = keyed_hmac
+
+
+    def render(self, timestamp):
+        headers = {
+            'x-auth-timestamp': timestamp,
+            'x-auth-signature': Util.sign(self._hmac, timestamp, self._path),
+            'Content-Type': 'application/json',
+        }
+        body = f'{{"time":{timestamp},{self._body}'
+        return headers, body
+
+
 class BitmaxREST_API(DefaultAPI):
     api_url = 'bitmax.io'
     api_path = '/api/pro/v1'
     ws_path = '/stream'
     account_group = None
+    warmup_url = 'https://bitmax.io/api/pro/v1/barhist/info'
+    # Bitmax sends no usage headers, the buckets are only tracked locally
+    rate_limits = {
+        'requests:1s': (10, 1),
+        'orders:1s': (5, 1),
+    }
+    endpoint_costs = {
+        None: {'requests:1s': 1},
+        ('post', '/cash/order'): {'requests:1s': 1, 'orders:1s': 1},
+    }
 
     def __init__(self, api_token, secret, account_group=None, logger=None):
         self.api_token = api_token
@@ -71,7 +129,9 @@ class BitmaxREST_API(DefaultAPI):
         headers = {
             'x-auth-key': self.api_token,
         }
-        session = aiohttp.ClientSession(headers=headers)
+        session = self.connection_pool.create_session(
+            headers=headers, json_serialize=general.json_dumps
+        )
         self.session = session
 
 
@@ -109,9 +169,9 @@ class BitmaxREST_API(DefaultAPI):
         return ws_url
 
 
-    async def connect_ws(self):
+    async def connect_ws(self, **kwargs):
         url = await self.get_ws_url(group_needed=True) + self.ws_path
-        return BitmaxWebSocket(url, self)
+        return BitmaxWebSocket(url, self, **kwargs)
 
 
     async def get_all_products(self):
@@ -135,10 +195,8 @@ class BitmaxREST_API(DefaultAPI):
         return headers
 
 
-    async def place_order(self, symbol, size, order_type, order_side, price=None, post_only=False, resp_inst='ACK', time_in_force='GTC'):
-        timestamp = int(datetime.datetime.now().timestamp() * 1000)
+    async def prepare_order(self, symbol, size, order_type, order_side, price=None, post_only=False, resp_inst='ACK', time_in_force='GTC'):
         data = {
-            'time': timestamp,
             'symbol': symbol,
             'orderQty': str(size),
             'orderType': order_type,
@@ -147,24 +205,57 @@ class BitmaxREST_API(DefaultAPI):
         }
         if order_type == 'limit':
             data['orderPrice'] = str(price)
-        resp = await self.post(path='/cash/order', data=data, group_needed=True)
-        return resp
-        # pprint.pprint(resp)
+        url = await self.get_api_url(group_needed=True) + '/cash/order'
+        return OrderTemplate(url, data, order_type, Util.get_hmac(self._secret))
+
+
+    async def place_prepared_order(self, template):
+        await self.governor.acquire('post', '/cash/order', RateGovernor.HIGH)
+        headers, body = template.render(Util.get_timestamp())
+        response = await self.session.post(
+            template.url, data=body, headers=headers
+        )
+        self.governor.update(response)
+        return await response.json(loads=general.json_loads)
 
 
-    async def get_rate(self, symbol):
+    async def place_order(self, symbol, size, order_type, order_side, price=None, post_only=False, resp_inst='ACK', time_in_force='GTC'):
+        template = await self.prepare_order(
+            symbol=symbol,
+            size=size,
+            order_type=order_type,
+            order_side=order_side,
+            price=price,
+            post_only=post_only,
+            resp_inst=resp_inst,
+            time_in_force=time_in_force,
+        )
+        return await self.place_prepared_order(template)
+
+
+    async def get_rate(self, symbol, priority=RateGovernor.LOW):
         result = await self.get(path='/ticker', params={
             'symbol': symbol
-        })
+        }, priority=priority)
         price = result['data']['close']
         return price
 
 
+    async def get_mid_price(self, symbol, priority=RateGovernor.LOW):
+        # Midpoint of the best bid and ask, the price the streams report
+        result = await self.get(path='/ticker', params={
+            'symbol': symbol
+        }, priority=priority)
+        return Util.get_mid_price(result['data'])
+
+
 class BitmaxWebSocket(WebSocketAPI):
+    FRAME_HEAD = re.compile(r'\{"m":"([^"]*)","symbol":"([^"]*)"')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._headers = Util.make_headers('stream', self._api_token, self._secret)
+        self.add_dispatcher(name='ping', key='ping', pass_index=True)(self.handle_ping)
 
 
     async def send_json_with_op(self, op, data, index):
@@ -185,11 +276,40 @@ class BitmaxWebSocket(WebSocketAPI):
         )
 
 
-    async def handle_firstly(self, message, index):
-        if message['m'] == 'ping':
-            if int(message['hp']) < 3:
-                self._logger.warning(message)
-            await self.send_json_with_op(op='pong', data={}, index=index)
+    async def unsubscribe_from_channel(self, channel, index=None, id=''):
+        if not index:
+            index = 0
+        await self.send_json_with_op(
+            'unsub',
+            data={
+                'ch': channel,
+                'id': id,
+            },
+            index=index,
+        )
+
+
+    def get_route_keys(self, data):
+        m = data.get('m')
+        symbol = data.get('symbol')
+        if symbol:
+            return (f'{m}:{symbol}', m)
+        return (m,)
+
+
+    def peek_route_keys(self, raw):
+        # Market data frames start with {"m":"<type>","symbol":"<symbol>"
+        match = self.FRAME_HEAD.match(raw)
+        if not match:
+            return None
+        m, symbol = match.groups()
+        return (f'{m}:{symbol}', m)
+
+
+    async def handle_ping(self, message, index):
+        if int(message['hp']) < 3:
+            self._logger.warning(message)
+        await self.send_json_with_op(op='pong', data={}, index=index)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+import asyncio
+import collections
+import logging
+
+import aiohttp
+
+from config import config
+import general
+
+logger = logging.getLogger(f'{general.logger_name}.connection_pool')
+
+
+class ConnectionPool:
+    # One TCPConnector shared by every API client, with per-host limits,
+    # DNS caching and keep-alive. Registered warmup urls are requested in
+    # the background so the exchanges' hosts always have live connections.
+
+    def __init__(
+        self,
+        limit=100,
+        limit_per_host=20,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+        warmup_interval=20,
+        warmup_connections=2,
+    ):
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._ttl_dns_cache = ttl_dns_cache
+        self._keepalive_timeout = keepalive_timeout
+        self._warmup_interval = warmup_interval
+        self._warmup_connections = warmup_connections
+        self._connector = None
+        self._users = 0
+        self._warmups = {}
+        self._warmer = None
+        self._stats = collections.Counter()
+        self._connect_time_total = 0.0
+        self._connect_time_max = 0.0
+        self._trace_config = self._make_trace_config()
+
+
+    def _make_trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_start.append(self._on_connection_create_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        return trace_config
+
+
+    async def _on_request_start(self, session, context, params):
+        self._stats['requests'] += 1
+
+
+    async def _on_connection_create_start(self, session, context, params):
+        context.connect_started = asyncio.get_event_loop().time()
+
+
+    async def _on_connection_create_end(self, session, context, params):
+        connect_time = asyncio.get_event_loop().time() - context.connect_started
+        self._stats['created'] += 1
+        self._connect_time_total += connect_time
+        self._connect_time_max = max(self._connect_time_max, connect_time)
+
+
+    async def _on_connection_reuseconn(self, session, context, params):
+        self._stats['reused'] += 1
+
+
+    def acquire(self):
+        if not self._connector or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                use_dns_cache=True,
+                ttl_dns_cache=self._ttl_dns_cache,
+                keepalive_timeout=self._keepalive_timeout,
+                enable_cleanup_closed=True,
+            )
+        self._users += 1
+        return self._connector
+
+
+    async def release(self):
+        self._users -= 1
+        if self._users > 0:
+            return None
+        if self._warmer:
+            self._warmer.cancel()
+            self._warmer = None
+        if self._connector:
+            await self._connector.close()
+            self._connector = None
+
+
+    def create_session(self, **kwargs):
+        return aiohttp.ClientSession(
+            connector=self.acquire(),
+            connector_owner=False,
+            trace_configs=[self._trace_config],
+            **kwargs
+        )
+
+
+    def add_warmup(self, url, session):
+        self._warmups[url] = session
+        if not self._warmer:
+            self._warmer = asyncio.create_task(self.warm())
+
+
+    def remove_warmup(self, session):
+        for url, warmup_session in list(self._warmups.items()):
+            if warmup_session is session:
+                del self._warmups[url]
+
+
+    async def _warm_one(self, url, session):
+        async with session.head(url, allow_redirects=False) as response:
+            await response.release()
+        self._stats['warmups'] += 1
+
+
+    async def warm(self):
+        while True:
+            requests = [
+                self._warm_one(url, session)
+                for url, session in list(self._warmups.items())
+                if not session.closed
+                for i in range(self._warmup_connections)
+            ]
+            results = await asyncio.gather(*requests, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    self._stats['warmup_errors'] += 1
+                    logger.warning(f'Warmup failed: {result!r}')
+            await asyncio.sleep(self._warmup_interval)
+
+
+    def get_stats(self):
+        created = self._stats['created']
+        reused = self._stats['reused']
+        connections = created + reused
+        return {
+            'requests': self._stats['requests'],
+            'created': created,
+            'reused': reused,
+            'reuse_ratio': reused / connections if connections else 0.0,
+            'connect_time_avg': self._connect_time_total / created if created else 0.0,
+            'connect_time_max': self._connect_time_max,
+            'warmups': self._stats['warmups'],
+            'warmup_errors': self._stats['warmup_errors'],
+        }
+
+
+# HTTP_POOL in the config overrides the defaults, e.g. {'limit_per_host': 10}
+shared_pool = ConnectionPool(**config.get('HTTP_POOL', {}))
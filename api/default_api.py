@@ -1,18 +1,187 @@
 import asyncio
 import aiohttp
 import random
+import time
+
+import general
+from .connection_pool import shared_pool
+from .rate_governor import RateGovernor
 
 
 import collections
 
 Dispatcher = collections.namedtuple('Dispatcher', [
-    'func', 'name'
+    'func', 'name', 'key', 'pass_index'
 ])
 
+class LatestMailbox:
+    # Keeps only the newest value per key and runs one consumer per key,
+    # so values that were overwritten before being consumed are dropped
+    # and handling of a single key is serialized
+
+    def __init__(self, handler, logger):
+        self._handler = handler
+        self._logger = logger
+        self._values = {}
+        self._consumers = {}
+        self._dropped = 0
+
+
+    def put(self, key, value):
+        if key in self._values:
+            self._dropped += 1
+        self._values[key] = value
+        if key not in self._consumers:
+            self._consumers[key] = asyncio.create_task(self._consume(key))
+
+
+    async def _consume(self, key):
+        try:
+            while key in self._values:
+                value = self._values.pop(key)
+                try:
+                    await self._handler(key, value)
+                except Exception as exc:
+                    self._logger.exception(exc)
+        finally:
+            del self._consumers[key]
+
+
+    def get_stats(self):
+        return {
+            'pending': len(self._values),
+            'consumers': len(self._consumers),
+            'dropped': self._dropped,
+        }
+
+
+class DispatchEngine:
+    # Bounded queue drained by a fixed number of workers. When the queue is
+    # full the policy decides what happens to a new item:
+    # BLOCK waits for free space (and so stalls the reader),
+    # DROP_OLDEST discards the head of the queue,
+    # DROP_BY_KEY replaces a queued item with the same key and falls back
+    # to DROP_OLDEST when there is none.
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_BY_KEY = 'drop_by_key'
+
+    def __init__(self, handler, logger, workers=1, maxsize=1024, policy=BLOCK, key=None):
+        if policy not in (self.BLOCK, self.DROP_OLDEST, self.DROP_BY_KEY):
+            raise ValueError(f'Unknown policy: {policy}')
+        if policy == self.DROP_BY_KEY and not key:
+            raise ValueError('DROP_BY_KEY needs a key function')
+        self._handler = handler
+        self._logger = logger
+        self._workers_num = workers
+        self._maxsize = maxsize
+        self._policy = policy
+        self._key = key
+        self._items = collections.deque()
+        self._keyed = {}
+        self._condition = asyncio.Condition()
+        self._workers = []
+        self._stats = collections.Counter()
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+
+    def start(self):
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._work()) for i in range(self._workers_num)
+            ]
+
+
+    def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+
+    def _drop_oldest(self):
+        entry = self._items.popleft()
+        key = entry[0]
+        if key is not None and self._keyed.get(key) is entry:
+            del self._keyed[key]
+        self._stats['dropped'] += 1
+
+
+    async def put(self, item):
+        key = self._key(item) if self._key else None
+        async with self._condition:
+            while len(self._items) >= self._maxsize:
+                if self._policy == self.BLOCK:
+                    self._stats['blocked'] += 1
+                    await self._condition.wait()
+                elif self._policy == self.DROP_BY_KEY and key in self._keyed:
+                    self._keyed[key][1] = item
+                    self._stats['dropped'] += 1
+                    return None
+                else:
+                    self._drop_oldest()
+            entry = [key, item]
+            if key is not None:
+                self._keyed[key] = entry
+            self._items.append(entry)
+            self._condition.notify_all()
+
+
+    async def _get(self):
+        async with self._condition:
+            while not self._items:
+                await self._condition.wait()
+            entry = self._items.popleft()
+            key, item = entry
+            if key is not None and self._keyed.get(key) is entry:
+                del self._keyed[key]
+            self._condition.notify_all()
+            return item
+
+
+    async def _work(self):
+        while True:
+            item = await self._get()
+            started = time.monotonic()
+            try:
+                await self._handler(item)
+            except Exception as exc:
+                self._stats['errors'] += 1
+                self._logger.exception(exc)
+            latency = time.monotonic() - started
+            self._stats['handled'] += 1
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+
+
+    def get_stats(self):
+        handled = self._stats['handled']
+        return {
+            'depth': len(self._items),
+            'maxsize': self._maxsize,
+            'policy': self._policy,
+            'workers': len(self._workers),
+            'handled': handled,
+            'dropped': self._stats['dropped'],
+            'blocked': self._stats['blocked'],
+            'errors': self._stats['errors'],
+            'latency_avg': self._latency_total / handled if handled else 0.0,
+            'latency_max': self._latency_max,
+        }
+
+
 class DefaultAPI:
     api_token = None
     api_url = None
     session = None
+    connection_pool = shared_pool
+    # Requested in the background to keep connections to the host alive
+    warmup_url = None
+    # RateGovernor setup, see rate_governor.py
+    rate_limits = None
+    endpoint_costs = None
+    usage_headers = None
+    governor = None
 
 
     def __init__(self, api_url, api_token=None):
@@ -21,16 +190,25 @@ class DefaultAPI:
 
 
     async def __aenter__(self):
+        self.governor = RateGovernor(
+            self.rate_limits, self.endpoint_costs, self.usage_headers
+        )
         await self.create_session()
+        if self.warmup_url:
+            self.connection_pool.add_warmup(self.warmup_url, self.session)
 
 
     async def __aexit__(self, *args, **kwargs):
+        self.connection_pool.remove_warmup(self.session)
         await self.session.close()
+        await self.connection_pool.release()
 
 
     async def create_session(self):
         headers = {}
-        session = aiohttp.ClientSession(headers=headers)
+        session = self.connection_pool.create_session(
+            headers=headers, json_serialize=general.json_dumps
+        )
         self.session = session
 
 
@@ -55,6 +233,7 @@ class DefaultAPI:
         data={},
         headers={},
         json=True,
+        priority=RateGovernor.NORMAL,
         *args, **kwargs
     ):
         headers = headers if headers else {}
@@ -72,6 +251,7 @@ class DefaultAPI:
         init_params.update(params)
         params = init_params
 
+        await self.governor.acquire(method, path, priority)
         if method == 'get':
             response = await self.session.get(url, params=params, headers=headers)
         elif method == 'post':
@@ -85,8 +265,9 @@ class DefaultAPI:
             response = await self.session.delete(url, params=params, headers=headers)
         elif method == 'put':
             response = await self.session.put(url, params=params, headers=headers)
+        self.governor.update(response)
         if json:
-            response = await response.json()
+            response = await response.json(loads=general.json_loads)
         return response
 
 
@@ -116,14 +297,38 @@ class WebSocketAPI:
         pass
 
     _dispatchers = None
+    _routes = None
+    # Reopen a closed connection right away instead of failing
+    # handle_messages, on_reconnect() restores its state
+    reconnect_in_place = False
 
-    def __init__(self, url, api, connection_num=1):
+    def __init__(
+        self,
+        url,
+        api,
+        connection_num=1,
+        dispatch_workers=1,
+        dispatch_queue_size=1024,
+        dispatch_policy=DispatchEngine.BLOCK,
+        dispatch_key=None,
+    ):
         self._url = url
         self._api = api
         self._dispatchers = []
+        self._routes = {}
         self._logger = api._logger
         self._connection_num = connection_num
         self._headers = {}
+        self._engines = {}
+        self._discarded = 0
+        self._readers = {}
+        self._failed = None
+        self._engine_config = {
+            'workers': dispatch_workers,
+            'maxsize': dispatch_queue_size,
+            'policy': dispatch_policy,
+            'key': dispatch_key,
+        }
 
 
     async def __aenter__(self):
@@ -143,6 +348,18 @@ class WebSocketAPI:
         return await self._session.ws_connect(self._url, headers=headers)
 
 
+    async def add_connection(self):
+        index = len(self.ws_pool)
+        self.ws_pool.append(await self.connect_ws(self._headers))
+        if self._failed and not self._failed.done():
+            self.start_reader(index)
+        return index
+
+
+    async def on_reconnect(self, index):
+        pass
+
+
     @property
     def _api_token(self):
         return self._api.api_token
@@ -162,38 +379,101 @@ class WebSocketAPI:
         return self.ws_pool[index].closed
 
 
-    def add_dispatcher(self, name=None):
+    def add_dispatcher(self, name=None, key=None, pass_index=False):
+        # Dispatchers without a key are the catch-all for messages
+        # no keyed dispatcher is registered for
         def decorator(func):
             dispatcher = Dispatcher(
-                func=func, name=name
+                func=func, name=name, key=key, pass_index=pass_index
             )
-            self._dispatchers.append(dispatcher)
+            if key is None:
+                self._dispatchers.append(dispatcher)
+            else:
+                self._routes.setdefault(key, []).append(dispatcher)
             return func
         return decorator
 
 
+    def get_route_keys(self, data):
+        # Candidate routing keys of a message, the most specific first
+        return ()
+
+
+    def peek_route_keys(self, raw):
+        # Same keys as get_route_keys taken from the raw frame without
+        # decoding it, None when they can't be told cheaply
+        return None
+
+
+    def is_routed(self, raw):
+        if self._dispatchers:
+            return True
+        keys = self.peek_route_keys(raw)
+        if keys is None:
+            return True
+        return any(key in self._routes for key in keys)
+
+
+    def get_dispatchers(self, data):
+        for key in self.get_route_keys(data):
+            dispatchers = self._routes.get(key)
+            if dispatchers:
+                return dispatchers
+        return self._dispatchers
+
+
     def get_random_ws_index(self):
         return random.choice(list(range(len(self.ws_pool))))
 
 
     async def send_json(self, index, data):
-        await self.ws_pool[index].send_json(data)
+        await self.ws_pool[index].send_json(data, dumps=general.json_dumps)
 
 
     async def receive_json(self, index):
-        response = await self.ws_pool[index].receive_json()
+        response = await self.ws_pool[index].receive_json(loads=general.json_loads)
         return response
 
 
-    async def handle_firstly(self, message, index):
-        pass
+    def get_engine(self, index):
+        engine = self._engines.get(index)
+        if not engine:
+            async def handler(data):
+                await self.dispatch_data(data, index)
+            engine = DispatchEngine(
+                handler, self._logger, **self._engine_config
+            )
+            self._engines[index] = engine
+        return engine
+
+
+    def get_stats(self):
+        return {
+            'connections': {
+                index: engine.get_stats()
+                for index, engine in self._engines.items()
+            },
+            'discarded': self._discarded,
+        }
+
+
+    async def dispatch_data(self, data, index):
+        for dispatcher in self.get_dispatchers(data):
+            try:
+                if dispatcher.pass_index:
+                    await dispatcher.func(data, index)
+                else:
+                    await dispatcher.func(data)
+            except Exception as exc:
+                self._logger.exception(exc)
 
 
     async def dispatch(self, message, index):
-        data = message.json()
-        asyncio.create_task(self.handle_firstly(data, index))
-        for dispatcher in self._dispatchers:
-            asyncio.create_task(dispatcher.func(data))
+        if not self.is_routed(message.data):
+            self._discarded += 1
+            return None
+        data = message.json(loads=general.json_loads)
+        await self.get_engine(index).put(data)
 
 
     async def handle_one_ws(self, index):
@@ -205,19 +485,45 @@ class WebSocketAPI:
                 aiohttp.WSMsgType.ERROR
             ):
                 exc = self.WSClosed(f'Dispatch: WebSocket apparently closed\n{message}')
-                raise exc
+                if not self.reconnect_in_place:
+                    raise exc
+                self._logger.warning(f'Reconnecting {index}: {exc}')
+                self.ws_pool[index] = await self.connect_ws(self._headers)
+                await self.on_reconnect(index)
+                continue
             elif message.type != aiohttp.WSMsgType.TEXT:
                 exc = ValueError(f'Non-text message\n{message}')
                 raise exc
             await self.dispatch(message, index)
 
 
+    def start_reader(self, index):
+        self.get_engine(index).start()
+        reader = asyncio.create_task(self.handle_one_ws(index))
+        reader.add_done_callback(self._on_reader_done)
+        self._readers[index] = reader
+
+
+    def _on_reader_done(self, reader):
+        if reader.cancelled() or self._failed.done():
+            return None
+        exc = reader.exception()
+        if exc:
+            self._failed.set_exception(exc)
+        else:
+            self._failed.set_result(None)
+
+
     async def handle_messages(self):
-        handlers = [self.handle_one_ws(i) for i in range(self._connection_num)]
-        handling_tasks = asyncio.gather(*handlers)
+        self._failed = asyncio.get_event_loop().create_future()
+        for index in range(len(self.ws_pool)):
+            self.start_reader(index)
 
         try:
-            await handling_tasks
-        except Exception as exc:
-            handling_tasks.cancel()
-            raise exc
+            await self._failed
+        finally:
+            for reader in self._readers.values():
+                reader.cancel()
+            self._readers.clear()
+            for engine in self._engines.values():
+                engine.stop()
@@ -0,0 +1,163 @@
+import asyncio
+import collections
+import email.utils
+import logging
+import time
+
+import general
+
+logger = logging.getLogger(f'{general.logger_name}.rate_governor')
+
+
+class TokenBucket:
+    # capacity tokens refilled evenly over interval seconds
+
+    def __init__(self, capacity, interval):
+        self.capacity = capacity
+        self.rate = capacity / interval
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+    def sync(self, used):
+        # The exchange's own count of the window wins over the local estimate
+        self.refill()
+        self.tokens = max(0, self.capacity - used)
+
+
+    def get_wait(self, cost, reserve):
+        # Seconds until cost tokens can be spent without going under reserve
+        self.refill()
+        missing = cost + reserve - self.tokens
+        return missing / self.rate if missing > 0 else 0
+
+
+class RateGovernor:
+    # Token buckets per exchange limit, with endpoint costs charged against
+    # them before each request. Lower priorities keep a share of every
+    # bucket in reserve, so they are throttled well before orders are.
+    # Usage headers resync the buckets after each response, 429/418 and
+    # Retry-After stop every request until the exchange allows them again.
+
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+    PRIORITY_NAMES = {
+        HIGH: 'high',
+        NORMAL: 'normal',
+        LOW: 'low',
+    }
+    RESERVE = {
+        HIGH: 0.0,
+        NORMAL: 0.2,
+        LOW: 0.5,
+    }
+    BAN_STATUSES = (418, 429)
+    DEFAULT_RETRY_AFTER = 60
+
+    def __init__(self, limits=None, costs=None, usage_headers=None):
+        # limits: {bucket: (capacity, interval)}
+        # costs: {(method, path): {bucket: cost}}, None is the default cost
+        # usage_headers: {header prefix: bucket prefix}
+        self._buckets = {
+            name: TokenBucket(capacity, interval)
+            for name, (capacity, interval) in (limits or {}).items()
+        }
+        self._costs = costs or {}
+        self._usage_headers = usage_headers or {}
+        self._blocked_until = 0
+        self._stats = collections.Counter()
+        self._waited = collections.Counter()
+
+
+    def get_cost(self, method, path):
+        cost = self._costs.get((method, path))
+        if cost is None:
+            cost = self._costs.get(None, {})
+        return cost
+
+
+    async def acquire(self, method, path, priority=NORMAL):
+        cost = self.get_cost(method, path)
+        priority_name = self.PRIORITY_NAMES[priority]
+        while True:
+            wait = self._blocked_until - time.monotonic()
+            for name, amount in cost.items():
+                bucket = self._buckets.get(name)
+                if bucket:
+                    reserve = bucket.capacity * self.RESERVE[priority]
+                    wait = max(wait, bucket.get_wait(amount, reserve))
+            if wait <= 0:
+                break
+            self._stats[f'throttled_{priority_name}'] += 1
+            self._waited[priority_name] += wait
+            await asyncio.sleep(wait)
+        for name, amount in cost.items():
+            bucket = self._buckets.get(name)
+            if bucket:
+                bucket.tokens -= amount
+        self._stats[f'requests_{priority_name}'] += 1
+
+
+    def get_retry_after(self, value):
+        # Retry-After is either seconds or an HTTP-date
+        if not value:
+            return self.DEFAULT_RETRY_AFTER
+        try:
+            return max(0, int(value))
+        except ValueError:
+            pass
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+            return max(0, date.timestamp() - time.time())
+        except (TypeError, ValueError, OverflowError):
+            logger.warning(f'Unparsable Retry-After: {value!r}')
+            return self.DEFAULT_RETRY_AFTER
+
+
+    def update(self, response):
+        headers = response.headers
+        for name, value in headers.items():
+            name = name.lower()
+            for header, bucket_prefix in self._usage_headers.items():
+                if not name.startswith(header):
+                    continue
+                bucket = self._buckets.get(
+                    f'{bucket_prefix}:{name[len(header):]}'
+                )
+                if bucket:
+                    bucket.sync(int(value))
+        if response.status in self.BAN_STATUSES:
+            retry_after = self.get_retry_after(headers.get('Retry-After'))
+            self._blocked_until = max(
+                self._blocked_until, time.monotonic() + retry_after
+            )
+            self._stats[f'status_{response.status}'] += 1
+            logger.warning(
+                f'Got {response.status} from {response.url}, '
+                f'requests are blocked for {retry_after}s'
+            )
+
+
+    def get_stats(self):
+        return {
+            'buckets': {
+                name: {
+                    'tokens': round(bucket.tokens, 2),
+                    'capacity': bucket.capacity,
+                }
+                for name, bucket in self._buckets.items()
+            },
+            'blocked_for': max(0, self._blocked_until - time.monotonic()),
+            'waited': {
+                priority: round(waited, 3) for priority, waited in self._waited.items()
+            },
+            **self._stats,
+        }
@@ -55,6 +55,10 @@ class AbstractDBClient(ABC):
     async def delete_order(self, pk):
         pass
 
+    @abstractmethod
+    async def delete_all_orders(self):
+        pass
+
     @abstractmethod
     async def delete_button(self, pk):
         pass
@@ -1,21 +1,78 @@
 import logging
 import asyncio
+import os
 import tortoise
 import general
 
+from tortoise import transactions
+
 from .abstract_db_client import AbstractDBClient
-from .models import Symbol, Order, ProcessingOrder, QuickButton
+from .models import Symbol, Order, ProcessingOrder, QuickButton, OrderType
+from .symbol_registry import SymbolRegistry
+from .trigger_book import TriggerBook
+from .journal import WriteBehindJournal
 
 logger = logging.getLogger(f'{general.logger_name}.dbclient')
 
 
 class DBClientWrapper:
+    # Applied to every connection on start, journal_mode=WAL is persistent,
+    # the others only last for the connection
+    PRAGMAS = (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('cache_size', -64 * 1024),
+        ('temp_store', 'MEMORY'),
+    )
+    INDEXES = (
+        'CREATE INDEX IF NOT EXISTS "idx_order_symbol_type_trigger" '
+        'ON "order" ("symbol_id", "order_type", "trigger_price");',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "uid_processing_order_order_id" '
+        'ON "processing_order" ("order_id");',
+    )
+    # (table, column, definition) added to databases that predate them
+    COLUMNS = (
+        ('symbol', 'delisted', 'INT NOT NULL DEFAULT 0'),
+    )
+
     def __init__(self, dbconfig):
         self._dbconfig = dbconfig
 
 
     async def __aenter__(self):
         await tortoise.Tortoise.init(self._dbconfig)
+        for name in self._dbconfig['connections']:
+            connection = tortoise.Tortoise.get_connection(name)
+            await self.apply_pragmas(connection)
+            await self.add_columns(connection)
+            await self.create_indexes(name, connection)
+
+
+    async def apply_pragmas(self, connection):
+        for pragma, value in self.PRAGMAS:
+            await connection.execute_script(f'PRAGMA {pragma}={value};')
+
+
+    async def add_columns(self, connection):
+        for table, column, definition in self.COLUMNS:
+            _, rows = await connection.execute_query(f'PRAGMA table_info("{table}")')
+            if rows and column not in (row['name'] for row in rows):
+                await connection.execute_script(
+                    f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition};'
+                )
+
+
+    async def create_indexes(self, name, connection):
+        # Existing databases predate these indexes
+        for index in self.INDEXES:
+            try:
+                await connection.execute_script(index)
+            except (
+                tortoise.exceptions.IntegrityError,
+                tortoise.exceptions.OperationalError,
+            ) as exc:
+                logger.error(f'{name}: {index} failed, {exc}')
 
 
     async def __aexit__(self, *args, **kwargs):
@@ -23,17 +80,40 @@ class DBClientWrapper:
 
 
 class DBClient(AbstractDBClient):
+    # A listing that would delist more than this share of the active
+    # symbols is taken for a broken response rather than a delisting
+    DELIST_MAX_FRACTION = 0.5
 
 
     def __init__(self, using_db):
         self._using_db = using_db
+        self._symbol_registry = SymbolRegistry()
+        self._trigger_book = TriggerBook()
+        self._next_processing_id = None
+        self._journal = WriteBehindJournal(
+            os.path.join(general.BASE_DIR, f'db/{using_db}.journal'),
+            using_db,
+            handlers={
+                'processing': self.write_processing,
+                'order_id': self.write_order_ids,
+                'delete_processing': self.write_processing_deletes,
+            },
+        )
 
 
     async def __aenter__(self):
         self._connection = tortoise.Tortoise.get_connection(self._using_db)
+        await self._journal.__aenter__()
+        last = await ProcessingOrder.all().order_by('-id').using_db(
+            self._connection
+        ).first()
+        self._next_processing_id = (last.pk if last else 0) + 1
+        await self.load_symbol_registry()
+        await self.load_trigger_book()
 
 
     async def __aexit__(self, *args, **kwargs):
+        await self._journal.__aexit__(*args, **kwargs)
         await tortoise.Tortoise.close_connections()
 
 
@@ -49,25 +129,104 @@ class DBClient(AbstractDBClient):
         return buttons
 
 
-    async def add_symbols(self, symbols):
-        for symbol in symbols:
-            existing = await Symbol.get_or_none(
-                first=symbol.base,
-                second=symbol.quote,
-            ).using_db(self._connection)
-            if not existing:
-                new_symbol = Symbol()
-                new_symbol.first = symbol.base
-                new_symbol.second = symbol.quote
-                new_symbol.ticker = symbol.name
-                await new_symbol.save(
-                    update_fields=tuple(),
-                    using_db=self._connection
-                )
+    async def add_symbols(self, products):
+        # products is an async iterable of Product, it is diffed against the
+        # registry as it streams in and all changes go in one transaction.
+        # renames in the result are [old ticker, new ticker] pairs
+        added = []
+        renamed = []
+        renames = []
+        relisted = []
+        listed = set()
+        async for product in products:
+            symbol = self._symbol_registry.get(product.base, product.quote)
+            if not symbol:
+                symbol = self.make_symbol(product.base, product.quote)
+                symbol.ticker = product.name
+                added.append(symbol)
+                continue
+            listed.add(symbol.pk)
+            if symbol.ticker != product.name:
+                renamed.append([product.name, symbol.pk])
+                renames.append([symbol.ticker, product.name])
+            if symbol.delisted:
+                relisted.append(symbol.pk)
+        delisted = [
+            symbol.pk for symbol in self._symbol_registry
+            if symbol.pk not in listed and not symbol.delisted
+        ]
+        active = sum(1 for symbol in self._symbol_registry if not symbol.delisted)
+        if delisted and (
+            not listed or len(delisted) > active * self.DELIST_MAX_FRACTION
+        ):
+            logger.warning(
+                f'{self._using_db}: not delisting {len(delisted)} of {active} '
+                f'symbols, the listing looks incomplete'
+            )
+            delisted = []
+
+        async with transactions.in_transaction(self._using_db) as transaction:
+            if added:
+                await Symbol.bulk_create(added, using_db=transaction)
+            if renamed:
+                await Symbol.save_tickers(renamed, transaction)
+            if delisted:
+                await Symbol.filter(id__in=delisted).using_db(
+                    transaction
+                ).update(delisted=True)
+            if relisted:
+                await Symbol.filter(id__in=relisted).using_db(
+                    transaction
+                ).update(delisted=False)
+        await self.load_symbol_registry()
+        if renames:
+            # The book is keyed by ticker
+            await self.load_trigger_book()
+        return {
+            'added': len(added),
+            'renamed': len(renamed),
+            'renames': renames,
+            'delisted': len(delisted),
+            'relisted': len(relisted),
+            'total': len(self._symbol_registry),
+        }
+
+
+    async def load_symbol_registry(self):
+        symbols = await Symbol.all().using_db(self._connection)
+        self._symbol_registry.load(symbols)
+
+
+    async def load_trigger_book(self):
+        self._trigger_book.clear()
+        async for order in await self.list_orders():
+            self._trigger_book.add(order)
+        logger.info(f'{self._using_db}: {len(self._trigger_book)} orders armed')
 
 
     async def add_order(self, symbol, *args, **kwargs):
-        return await symbol.add_order(*args, using_db=self._connection, **kwargs)
+        order = await symbol.add_order(*args, using_db=self._connection, **kwargs)
+        self._trigger_book.add(order)
+        return order
+
+
+    async def add_orders(self, rows):
+        # rows are add_order keyword dicts, inserted in one transaction.
+        # bulk_create gives no pks back, new rows get ids above the last one
+        async with transactions.in_transaction(self._using_db) as transaction:
+            last = await Order.all().order_by('-id').limit(1).using_db(
+                transaction
+            ).values_list('id', flat=True)
+            last_id = last[0] if last else 0
+            await Order.bulk_create(
+                [Order(**row) for row in rows], using_db=transaction
+            )
+            orders = await Order.filter(id__gt=last_id).order_by(
+                'id'
+            ).prefetch_related('symbol').using_db(transaction)
+        for order in orders:
+            self._trigger_book.add(order)
+        return orders
 
 
     async def add_button(self, order_type, volume):
@@ -84,6 +243,7 @@ class DBClient(AbstractDBClient):
         symbol = await Symbol.get_or_none(pk=pk).using_db(self._connection)
         if symbol:
             await symbol.delete(using_db=self._connection)
+            await self.load_symbol_registry()
         else:
             raise self.NoSymbolExists(str(pk))
         return symbol
@@ -99,11 +259,21 @@ class DBClient(AbstractDBClient):
 
 
     async def delete_order(self, pk):
+        # A triggered order keeps its row until the journal moves it to
+        # processing, it can't be deleted as an armed one
+        if not self._trigger_book.has_order(pk):
+            raise self.NoOrderExists(str(pk))
         order = await self.get_order(pk=pk)
         await order.delete(using_db=self._connection)
+        self._trigger_book.discard(order)
         return order
 
 
+    async def delete_all_orders(self):
+        await Order.all().using_db(self._connection).delete()
+        self._trigger_book.clear()
+
+
     async def delete_button(self, pk):
         button = await QuickButton.get_or_none(pk=pk).using_db(self._connection)
         if button:
@@ -114,20 +284,45 @@ class DBClient(AbstractDBClient):
 
 
     async def list_symbols(self):
-        symbols = Symbol.all().using_db(self._connection)
+        symbols = Symbol.filter(delisted=False).using_db(self._connection)
         if self._using_db == 'bitmax':
             symbols = symbols.filter(second='USDT')
         return symbols
 
 
     async def list_orders(self):
+        # Triggered orders leave the table once the journal is committed
+        await self._journal.flush()
         orders = Order.all().prefetch_related(
             'symbol'
         ).using_db(self._connection)
         return orders
 
 
+    async def iter_order_dicts(self, chunk_size=500):
+        # One joined query per chunk, paged by id so the event loop gets
+        # control back between chunks. Rows of triggered orders the journal
+        # has not moved yet are skipped
+        last_id = 0
+        while True:
+            rows = await Order.filter(id__gt=last_id).order_by('id').limit(
+                chunk_size
+            ).using_db(self._connection).values(*Order.ROW_FIELDS)
+            if not rows:
+                return
+            orders = [
+                Order.row_to_dict(row) for row in rows
+                if self._trigger_book.has_order(row['id'])
+            ]
+            if orders:
+                yield orders
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1]['id']
+
+
     async def list_processing_orders(self):
+        await self._journal.flush()
         orders = ProcessingOrder.all().prefetch_related(
             'symbol'
         ).using_db(self._connection)
@@ -135,54 +330,126 @@ class DBClient(AbstractDBClient):
 
 
     async def get_symbol_by_pk(self, pk):
-        symbol = await Symbol.get_or_none(
-            pk=pk
-        ).using_db(self._connection)
+        symbol = self._symbol_registry.get_by_pk(pk)
         if not symbol:
             raise self.NoSymbolExists(f'{pk}')
         return symbol
 
 
     async def get_symbol_by_ticker(self, ticker):
-        symbol = await Symbol.get_or_none(
-            ticker=ticker
-        ).using_db(self._connection)
+        symbol = self._symbol_registry.get_by_ticker(ticker)
         if not symbol:
             raise self.NoSymbolExists(f'{ticker}')
         return symbol
 
 
     async def get_symbol(self, first, second):
-        symbol = await Symbol.get_or_none(
-            first=first,
-            second=second,
-        ).using_db(self._connection)
+        symbol = self._symbol_registry.get(first, second)
         if not symbol:
             exc = self.NoSymbolExists(f'{first}/{second}')
             raise exc
         return symbol
 
 
+    def is_armed(self, ticker):
+        return ticker in self._trigger_book
+
+
+    def is_order_armed(self, pk):
+        return self._trigger_book.has_order(pk)
+
+
+    def is_crossed(self, ticker, bid, ask=None):
+        return self._trigger_book.is_crossed(ticker, bid, ask)
+
+
     async def get_orders_for_price_bid(self, price, symbol):
-        return await symbol.get_orders_for_price_bid(
-            price, self._connection
-        )
+        return self._trigger_book.get_orders_for_price_bid(symbol.ticker, price)
 
 
     async def get_orders_for_price_ask(self, price, symbol):
-        return await symbol.get_orders_for_price_ask(
-            price, self._connection
-        )
+        return self._trigger_book.get_orders_for_price_ask(symbol.ticker, price)
+
+
+    def get_crossed_tickers(self, prices):
+        return self._trigger_book.get_crossed_tickers(prices)
+
+
+    async def make_processing(self, order, order_id=None):
+        pairs = await self.make_processing_many([order])
+        if not pairs:
+            return None
+        p_order = pairs[0][1]
+        if order_id:
+            self.save_order_id(p_order, order_id)
+        return p_order
+
+
+    async def make_processing_many(self, orders):
+        # Taking the orders out of the book makes sure concurrent ticks
+        # can't trigger them twice, the rows are written behind
+        orders = [order for order in orders if self._trigger_book.discard(order)]
+        if not orders:
+            return []
+        pairs = []
+        for order in orders:
+            pairs.append((order, order.to_processing(self._next_processing_id)))
+            self._next_processing_id += 1
+        self._journal.append('processing', {
+            'orders': [order.pk for order in orders],
+            'rows': [p_order.to_row() for order, p_order in pairs],
+        })
+        return pairs
+
+
+    def save_order_id(self, p_order, order_id):
+        p_order.order_id = order_id
+        return self._journal.append('order_id', [order_id, p_order.pk])
+
+
+    def delete_processing(self, p_order):
+        return self._journal.append('delete_processing', p_order.pk)
 
 
-    async def make_processing(self, order, order_id):
-        return await order.make_processing(
-            order_id,
-            using_db=self._connection,
-            connection_name=self._using_db,
+    def restore_processing(self, p_order):
+        # Brings back the row of a deleted processing order, its order is
+        # already gone from the orders table
+        return self._journal.append('processing', {
+            'orders': [],
+            'rows': [p_order.to_row()],
+        })
+
+
+    def flush(self):
+        return self._journal.flush()
+
+
+    async def write_processing(self, records, transaction):
+        pks = [pk for record in records for pk in record['orders']]
+        if pks:
+            await Order.filter(id__in=pks).using_db(transaction).delete()
+        await ProcessingOrder.insert_rows(
+            [row for record in records for row in record['rows']], transaction
         )
 
 
+    async def write_order_ids(self, records, transaction):
+        await ProcessingOrder.save_order_ids(records, transaction)
+
+
+    async def write_processing_deletes(self, records, transaction):
+        await ProcessingOrder.filter(
+            id__in=records
+        ).using_db(transaction).delete()
+
+
+    def get_stats(self):
+        return {
+            'armed': len(self._trigger_book),
+            'journal': self._journal.get_stats(),
+        }
+
+
 class BitmaxDBClient(DBClient):
 
 
@@ -197,11 +464,42 @@ class BinanceDBClient(DBClient):
         super().__init__(using_db='binance')
 
 
+def get_hot_queries():
+    return {
+        'orders_for_price_bid': Order.filter(
+            symbol_id=1, order_type=OrderType.BUY, trigger_price__gte=0
+        ),
+        'orders_for_price_ask': Order.filter(
+            symbol_id=1, order_type=OrderType.SELL, trigger_price__lte=0
+        ),
+        'symbol_orders': Order.filter(symbol_id=1),
+        'processing_by_order_id': ProcessingOrder.filter(order_id='0'),
+    }
+
+
+async def explain_hot_queries(connection):
+    # Plans without an index show up as a bare SCAN of the table
+    plans = {}
+    for name, query in get_hot_queries().items():
+        _, rows = await connection.execute_query(
+            f'EXPLAIN QUERY PLAN {query.using_db(connection).sql()}'
+        )
+        plans[name] = [row['detail'] for row in rows]
+    return plans
+
+
 if __name__ == '__main__':
     async def main():
-        client = BinanceDBClient(general.dbconfig)
-        async with client:
-            async for symbol in await client.list_symbols():
-                print(symbol.pk)
+        async with DBClientWrapper(general.dbconfig):
+            for name in general.dbconfig['connections']:
+                connection = tortoise.Tortoise.get_connection(name)
+                for query, plan in (await explain_hot_queries(connection)).items():
+                    scan = any(
+                        step.startswith('SCAN') and 'INDEX' not in step
+                        for step in plan
+                    )
+                    print(f'{name}.{query}{" FULL SCAN" if scan else ""}')
+                    for step in plan:
+                        print(f'    {step}')
 
     asyncio.run(main())
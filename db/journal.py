@@ -0,0 +1,201 @@
+import asyncio
+import collections
+import itertools
+import logging
+import os
+
+from tortoise import transactions
+
+import general
+
+logger = logging.getLogger(f'{general.logger_name}.journal')
+
+JournalRecord = collections.namedtuple('JournalRecord', [
+    'seq', 'op', 'data', 'future'
+])
+
+
+class WriteBehindJournal:
+    # State changes are appended to an NDJSON journal and queued, a single
+    # writer task applies everything queued so far in one transaction and
+    # then marks it committed. Records after the last commit mark are
+    # replayed on start, so handlers must be idempotent.
+    # Journal lines reach the OS on append, the writer fsyncs once per batch.
+    # Records that could not be applied hold the commit mark back, they are
+    # replayed with everything after them on the next start.
+
+    def __init__(self, path, connection_name, handlers, max_batch=256):
+        self._path = path
+        self._connection_name = connection_name
+        self._handlers = handlers
+        self._max_batch = max_batch
+        self._queue = asyncio.Queue()
+        self._file = None
+        self._seq = 0
+        self._last_future = None
+        self._writer = None
+        self._failed = []
+        self._stats = collections.Counter()
+
+
+    async def __aenter__(self):
+        await self.replay()
+        self._file = open(self._path, 'a', encoding='utf-8')
+        self._writer = asyncio.create_task(self.run())
+
+
+    async def __aexit__(self, *args, **kwargs):
+        try:
+            # A writer that died would never resolve the flush
+            await asyncio.wait(
+                [self.flush(), self._writer], return_when=asyncio.FIRST_COMPLETED
+            )
+            if self._writer.done():
+                # Raises whatever stopped the writer
+                self._writer.result()
+            self._writer.cancel()
+        finally:
+            self._file.close()
+
+
+    def _append(self, record):
+        self._file.write(general.json_dumps(record) + '\n')
+        self._file.flush()
+
+
+    def append(self, op, data):
+        # Returns a future resolved with True once the change is committed
+        # and with False when it could not be applied
+        self._seq += 1
+        future = asyncio.get_event_loop().create_future()
+        self._append({'seq': self._seq, 'op': op, 'data': data})
+        self._queue.put_nowait(JournalRecord(self._seq, op, data, future))
+        self._last_future = future
+        self._stats['appended'] += 1
+        return future
+
+
+    def flush(self):
+        # Awaitable that resolves once everything appended so far is committed
+        future = self._last_future
+        if not future:
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(True)
+        return future
+
+
+    async def run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty() and len(batch) < self._max_batch:
+                batch.append(self._queue.get_nowait())
+            try:
+                await self.commit(batch)
+            except Exception as exc:
+                # fsync or the journal file failing must not stop the writer
+                logger.exception(f'Committing a batch of {len(batch)} failed: {exc}')
+                self._stats['failed_batches'] += 1
+                self._failed.extend(
+                    record for record in batch if not record.future.done()
+                )
+                self._resolve(batch, {})
+
+
+    def _resolve(self, batch, results):
+        for record in batch:
+            if not record.future.done():
+                record.future.set_result(results.get(record.seq, False))
+
+
+    async def _apply(self, records):
+        async with transactions.in_transaction(self._connection_name) as transaction:
+            for op, run in itertools.groupby(records, key=lambda record: record.op):
+                await self._handlers[op](
+                    [record.data for record in run], transaction
+                )
+
+
+    async def _apply_each(self, records):
+        # Returns {seq: applied}, one bad record must not take the rest of
+        # the batch with it
+        try:
+            await self._apply(records)
+            return dict.fromkeys((record.seq for record in records), True)
+        except Exception as exc:
+            logger.warning(
+                f'Batch of {len(records)} failed, applying one by one: {exc}'
+            )
+        results = {}
+        for record in records:
+            try:
+                await self._apply([record])
+                results[record.seq] = True
+            except Exception as exc:
+                logger.error(f'Could not apply {record.op} {record.data}: {exc}')
+                results[record.seq] = False
+        return results
+
+
+    async def commit(self, batch):
+        # fsync can block for milliseconds, it runs off the event loop but
+        # still completes before the batch is applied
+        await asyncio.get_event_loop().run_in_executor(
+            None, os.fsync, self._file.fileno()
+        )
+        results = await self._apply_each(batch)
+        failed = [record for record in batch if not results[record.seq]]
+        self._failed.extend(failed)
+        self._stats['failed'] += len(failed)
+        if self._queue.empty() and not self._failed:
+            # Everything appended is committed, the journal starts over
+            self._file.truncate(0)
+        elif self._failed:
+            self._append({'commit': self._failed[0].seq - 1})
+        else:
+            self._append({'commit': batch[-1].seq})
+        self._stats['batches'] += 1
+        self._stats['committed'] += len(batch) - len(failed)
+        self._stats['batch_max'] = max(self._stats['batch_max'], len(batch))
+        self._resolve(batch, results)
+
+
+    async def replay(self):
+        if not os.path.exists(self._path):
+            return None
+        records = []
+        with open(self._path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = general.json_loads(line)
+                except ValueError:
+                    # A line cut short by the crash
+                    continue
+                if 'commit' in entry:
+                    records = [
+                        record for record in records if record.seq > entry['commit']
+                    ]
+                else:
+                    records.append(JournalRecord(
+                        entry['seq'], entry['op'], entry['data'], None
+                    ))
+        if records:
+            logger.warning(f'Replaying {len(records)} journal records')
+            results = await self._apply_each(records)
+            failed = [record for record in records if not results[record.seq]]
+            if failed:
+                # Kept next to the journal for a manual look
+                logger.error(f'{len(failed)} journal records could not be replayed')
+                with open(f'{self._path}.failed', 'a', encoding='utf-8') as file:
+                    for record in failed:
+                        file.write(general.json_dumps({
+                            'seq': record.seq, 'op': record.op, 'data': record.data,
+                        }) + '\n')
+        os.remove(self._path)
+
+
+    def get_stats(self):
+        return {
+            'pending': self._queue.qsize(),
+            'failed_pending': len(self._failed),
+            **self._stats,
+        }
@@ -18,6 +18,7 @@ class Symbol(Model):
     first = fields.CharField(max_length=10)
     second = fields.CharField(max_length=10)
     ticker = fields.CharField(max_length=21)
+    delisted = fields.BooleanField(default=False)
     orders: fields.ReverseRelation["db.Order"]
     processing_orders: fields.ReverseRelation["db.ProcessingOrder"]
 
@@ -68,6 +69,15 @@ class Symbol(Model):
         return orders
 
 
+    @classmethod
+    async def save_tickers(cls, tickers, using_db):
+        # tickers are [ticker, pk] pairs
+        await using_db.execute_many(
+            f'UPDATE "{cls._meta.db_table}" SET "ticker"=? WHERE "id"=?',
+            tickers,
+        )
+
+
     class Meta:
         table = 'symbol'
         ordering = [
@@ -76,6 +86,18 @@ class Symbol(Model):
 
 
 class Order(Model):
+    # Fields read by values() for bulk serialization, see row_to_dict()
+    ROW_FIELDS = (
+        'id',
+        'symbol__first',
+        'symbol__second',
+        'trigger_price',
+        'order_type',
+        'price',
+        'volume',
+        'add_timestamp',
+    )
+
     id = fields.IntField(pk=True)
     symbol = fields.ForeignKeyField('db.Symbol', related_name='orders')
     trigger_price = fields.FloatField()
@@ -97,27 +119,37 @@ class Order(Model):
         }
 
 
+    @staticmethod
+    def row_to_dict(row):
+        # Same output as to_dict() for a values(*ROW_FIELDS) row
+        add_timestamp = row['add_timestamp']
+        return {
+            'id': row['id'],
+            'symbol': f'{row["symbol__first"]}/{row["symbol__second"]}',
+            'trigger_price': row['trigger_price'],
+            'order_type': int(row['order_type']),
+            'price': row['price'],
+            'volume': row['volume'],
+            'add_timestamp': (
+                add_timestamp.strftime('%H:%M:%S %d-%m-%Y') if add_timestamp else None
+            ),
+        }
+
+
     class Meta:
         table = 'order'
 
 
-    async def make_processing(self, order_id, using_db, connection_name):
-        if order_id:
-            existing_order = ProcessingOrder.filter(order_id=order_id).using_db(using_db)
-            if not await existing_order.exists():
-                raise Exception(f'Already exists {order_id}')
-
-        symbol = await self.symbol
-        async with transactions.in_transaction(connection_name) as transaction:
-            p_order = ProcessingOrder()
-            p_order.order_id = order_id
-            p_order.symbol = symbol
-            p_order.price = self.price
-            p_order.order_type = self.order_type
-            p_order.volume = self.volume
-            p_order.status = Status.PROCESSING
-            await p_order.save(using_db=transaction)
-            await self.delete(using_db=transaction)
+    def to_processing(self, pk):
+        # The id is assigned up front so that the row can be referenced
+        # before it is written
+        p_order = ProcessingOrder()
+        p_order.id = pk
+        p_order.symbol = self.symbol
+        p_order.price = self.price
+        p_order.order_type = self.order_type
+        p_order.volume = self.volume
+        p_order.status = Status.PROCESSING
         return p_order
 
 
@@ -147,7 +179,7 @@ class Status(enum.IntEnum):
 
 class ProcessingOrder(Model):
     id = fields.IntField(pk=True)
-    order_id = fields.CharField(max_length=32, null=True)
+    order_id = fields.CharField(max_length=32, null=True, unique=True)
     symbol = fields.ForeignKeyField('db.Symbol', related_name='processing_orders')
     order_type = fields.IntEnumField(enum_type=OrderType)
     status = fields.IntEnumField(enum_type=Status)
@@ -159,6 +191,38 @@ class ProcessingOrder(Model):
         table = 'processing_order'
 
 
+    def to_row(self):
+        return [
+            self.pk,
+            self.order_id,
+            self.symbol_id,
+            int(self.order_type),
+            int(self.status),
+            self.price,
+            self.volume,
+        ]
+
+
+    @classmethod
+    async def insert_rows(cls, rows, using_db):
+        # Rows come from to_row(), already written ids are skipped
+        await using_db.execute_many(
+            f'INSERT OR IGNORE INTO "{cls._meta.db_table}" '
+            '("id", "order_id", "symbol_id", "order_type", "status", "price", "volume") '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            rows,
+        )
+
+
+    @classmethod
+    async def save_order_ids(cls, order_ids, using_db):
+        # order_ids are [order_id, pk] pairs
+        await using_db.execute_many(
+            f'UPDATE "{cls._meta.db_table}" SET "order_id"=? WHERE "id"=?',
+            order_ids,
+        )
+
+
     async def to_str(self):
         symbol = await self.symbol
         order_type = 'BUY' if self.order_type == OrderType.BUY else 'SELL'
@@ -0,0 +1,40 @@
+class SymbolRegistry:
+    # In-process copy of the symbol table. Lookups are plain dict reads,
+    # reloading builds new indexes and swaps them in at once so readers
+    # never see a half-filled registry.
+
+    def __init__(self):
+        self._by_pk = {}
+        self._by_ticker = {}
+        self._by_pair = {}
+
+
+    def __len__(self):
+        return len(self._by_pk)
+
+
+    def __iter__(self):
+        return iter(list(self._by_pk.values()))
+
+
+    def load(self, symbols):
+        by_pk = {}
+        by_ticker = {}
+        by_pair = {}
+        for symbol in symbols:
+            by_pk[symbol.pk] = symbol
+            by_ticker[symbol.ticker] = symbol
+            by_pair[(symbol.first, symbol.second)] = symbol
+        self._by_pk, self._by_ticker, self._by_pair = by_pk, by_ticker, by_pair
+
+
+    def get_by_pk(self, pk):
+        return self._by_pk.get(pk)
+
+
+    def get_by_ticker(self, ticker):
+        return self._by_ticker.get(ticker)
+
+
+    def get(self, first, second):
+        return self._by_pair.get((first, second))
@@ -0,0 +1,123 @@
+import bisect
+import math
+
+from .models import OrderType
+
+
+class TriggerBook:
+    # Per-ticker in-memory copy of the armed orders.
+    # BUY entries are kept as (-trigger_price, pk) so that both sides are
+    # sorted ascending and every crossed order is a prefix of its list.
+    # Watermarks hold (highest BUY trigger, lowest SELL trigger) per ticker.
+
+    def __init__(self):
+        self._buy = {}
+        self._sell = {}
+        self._orders = {}
+        self._watermarks = {}
+
+
+    def __contains__(self, ticker):
+        return ticker in self._watermarks
+
+
+    def __len__(self):
+        return len(self._orders)
+
+
+    def has_order(self, pk):
+        return pk in self._orders
+
+
+    def clear(self):
+        self._buy.clear()
+        self._sell.clear()
+        self._orders.clear()
+        self._watermarks.clear()
+
+
+    def _get_entry(self, order):
+        if int(order.order_type) == OrderType.BUY:
+            return self._buy, (-order.trigger_price, order.pk)
+        else:
+            return self._sell, (order.trigger_price, order.pk)
+
+
+    def add(self, order):
+        if order.pk in self._orders:
+            self.discard(order)
+        side, entry = self._get_entry(order)
+        ticker = order.symbol.ticker
+        bisect.insort(side.setdefault(ticker, []), entry)
+        self._orders[order.pk] = order
+        self._update_watermarks(ticker)
+
+
+    def discard(self, order):
+        order = self._orders.pop(order.pk, None)
+        if not order:
+            return False
+        side, entry = self._get_entry(order)
+        ticker = order.symbol.ticker
+        entries = side[ticker]
+        index = bisect.bisect_left(entries, entry)
+        del entries[index]
+        if not entries:
+            del side[ticker]
+        self._update_watermarks(ticker)
+        return True
+
+
+    def _update_watermarks(self, ticker):
+        buy = self._buy.get(ticker)
+        sell = self._sell.get(ticker)
+        if not (buy or sell):
+            self._watermarks.pop(ticker, None)
+            return
+        self._watermarks[ticker] = (
+            -buy[0][0] if buy else -math.inf,
+            sell[0][0] if sell else math.inf,
+        )
+
+
+    def get_watermarks(self, ticker):
+        return self._watermarks.get(ticker)
+
+
+    def is_crossed(self, ticker, bid, ask=None):
+        # BUY triggers fire on the ask, SELL triggers on the bid,
+        # a single last price is used for both sides
+        watermarks = self._watermarks.get(ticker)
+        if not watermarks:
+            return False
+        if ask is None:
+            ask = bid
+        return ask <= watermarks[0] or bid >= watermarks[1]
+
+
+    def _get_crossed(self, entries, key):
+        if not entries:
+            return []
+        end = bisect.bisect_right(entries, (key, math.inf))
+        return [self._orders[pk] for _, pk in entries[:end]]
+
+
+    def get_orders_for_price_bid(self, ticker, price):
+        return self._get_crossed(self._buy.get(ticker), -price)
+
+
+    def get_orders_for_price_ask(self, ticker, price):
+        return self._get_crossed(self._sell.get(ticker), price)
+
+
+    def get_crossed_tickers(self, prices):
+        # Single pass over a whole (ticker, bid, ask) snapshot against the
+        # watermarks, prices of unarmed tickers are not even parsed
+        crossed = set()
+        for ticker, bid, ask in prices:
+            watermarks = self._watermarks.get(ticker)
+            if not watermarks:
+                continue
+            if float(ask) <= watermarks[0] or float(bid) >= watermarks[1]:
+                crossed.add(ticker)
+        return crossed
@@ -13,6 +13,32 @@ from config import config
 Product = namedtuple('Product', ('base', 'quote', 'name'))
 
 
+#### JSON CODEC ####
+
+# orjson is optional, stdlib json is used when it isn't installed
+# or JSON_CODEC is set to 'json' in the config
+
+json_codec = config.get('JSON_CODEC', 'orjson')
+
+if json_codec == 'orjson':
+    try:
+        import orjson
+    except ImportError:
+        json_codec = 'json'
+
+if json_codec == 'orjson':
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+else:
+    import json
+
+    json_codec = 'json'
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+
 #### DATABASE CONFIG ####
 
 DEBUG = config.get('DEBUG', False)
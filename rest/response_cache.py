@@ -0,0 +1,74 @@
+from aiohttp import web
+
+import collections
+import gzip
+import general
+import uuid
+
+CachedBody = collections.namedtuple('CachedBody', [
+    'etag', 'body', 'gzipped'
+])
+
+
+class ResponseCache:
+    # Serialized responses per (stock, key), kept plain and gzip encoded.
+    # Mutating handlers invalidate their key, which bumps its version. The
+    # ETag is a per-process token plus the version, so tags handed out
+    # before a restart never match.
+
+    def __init__(self, min_gzip_size=1024):
+        self._min_gzip_size = min_gzip_size
+        self._token = uuid.uuid4().hex[:8]
+        self._versions = collections.Counter()
+        self._entries = {}
+        self._stats = collections.Counter()
+
+
+    def invalidate(self, stock, key):
+        self._versions[(stock, key)] += 1
+        self._entries.pop((stock, key), None)
+        self._stats['invalidated'] += 1
+
+
+    async def get(self, stock, key, build):
+        # build() is awaited for the data on a miss
+        entry = self._entries.get((stock, key))
+        if entry:
+            self._stats['hits'] += 1
+            return entry
+        self._stats['misses'] += 1
+        version = self._versions[(stock, key)]
+        body = general.json_dumps(await build()).encode('utf-8')
+        gzipped = None
+        if len(body) >= self._min_gzip_size:
+            gzipped = gzip.compress(body, compresslevel=6)
+        entry = CachedBody(f'"{self._token}-{stock}-{key}-{version}"', body, gzipped)
+        # An invalidation while building means the data may already be old
+        if self._versions[(stock, key)] == version:
+            self._entries[(stock, key)] = entry
+        return entry
+
+
+    def respond(self, request, entry):
+        headers = {
+            'ETag': entry.etag,
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding',
+        }
+        if entry.etag in request.headers.get('If-None-Match', ''):
+            self._stats['not_modified'] += 1
+            return web.Response(status=304, headers=headers)
+        body = entry.body
+        if entry.gzipped and 'gzip' in request.headers.get('Accept-Encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            body = entry.gzipped
+        return web.Response(
+            body=body, content_type='application/json', headers=headers
+        )
+
+
+    def get_stats(self):
+        return {
+            'entries': len(self._entries),
+            **self._stats,
+        }
@@ -1,9 +1,11 @@
-from aiohttp import web, web_exceptions
+from aiohttp import web, web_exceptions, WSMsgType
+from api.rate_governor import RateGovernor
 from db.models import Symbol, Order
+from rest.response_cache import ResponseCache
 
 import asyncio
+import functools
 import general
-import json
 import logging
 import math
 
@@ -14,6 +16,83 @@ handler.setFormatter(general.logger_formatter)
 logger.addHandler(handler)
 
 DB_PATH = 'db/db.sqlite3'
+IMPORT_BATCH = 500
+PUSH_SEND_TIMEOUT = 10
+
+json_response = functools.partial(web.json_response, dumps=general.json_dumps)
+
+
+async def stream_json_list(request, key, chunks, headers=None):
+    # Writes {"key": [...]} with chunked encoding, chunks is an async
+    # iterable of lists, each list is encoded and sent as it comes
+    response = web.StreamResponse(headers=headers)
+    response.content_type = 'application/json'
+    # Headers set by middlewares come too late for a prepared response
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    await response.write(f'{{"{key}":['.encode('utf-8'))
+    separator = ''
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        body = ','.join(general.json_dumps(item) for item in chunk)
+        await response.write(f'{separator}{body}'.encode('utf-8'))
+        separator = ','
+    await response.write(b']}')
+    await response.write_eof()
+    return response
+
+
+async def prepare_ndjson(request, headers=None):
+    response = web.StreamResponse(headers=headers)
+    response.content_type = 'application/x-ndjson'
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    return response
+
+
+async def write_ndjson(response, items):
+    if items:
+        body = ''.join(general.json_dumps(item) + '\n' for item in items)
+        await response.write(body.encode('utf-8'))
+
+
+async def iter_part_lines(part, chunk_size=64*1024):
+    # Only the current chunk and an unfinished line are held in memory
+    tail = b''
+    while True:
+        chunk = await part.read_chunk(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line
+    if tail:
+        yield tail
+
+
+async def iter_dump_records(part):
+    # Yields (line number, order dict or the error parsing it). Dumps made
+    # before NDJSON are one {"orders": [...]} document, their orders are
+    # numbered as if they were lines
+    number = 0
+    async for line in iter_part_lines(part):
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            record = general.json_loads(line)
+        except ValueError as exc:
+            yield number, exc
+            continue
+        if isinstance(record, dict) and 'orders' in record:
+            for index, order in enumerate(record['orders'], 1):
+                yield index, order
+        else:
+            yield number, record
 
 
 class RestServer:
@@ -39,6 +118,7 @@ class RestServer:
         ], logger=logger)
         self._prefix = '/api'
         self.bot = bot
+        self._responses = ResponseCache()
         self.set_views()
         self.runner = web.AppRunner(self._app)
 
@@ -62,28 +142,32 @@ class RestServer:
 
 
     async def get_user_info(self, request):
-        response = await request.bot.api.get('/info')
-        return web.json_response(response)
+        response = await request.bot.api.get(
+            '/info', priority=RateGovernor.LOW
+        )
+        return json_response(response)
 
 
     async def update_symbols_handler(self, request):
-        await request.bot.update_symbols()
-        data = {'data':[]}
+        counts = await request.bot.update_symbols()
+        self._responses.invalidate(request.stock_name, 'symbols')
+        data = {'data':[], 'counts': counts}
         async for symbol in await request.bot.dbclient.list_symbols():
             data['data'].append(await symbol.to_dict())
-        return web.json_response(data)
+        return json_response(data)
 
 
     async def update_symbol_handler(self, request):
         pk = request.match_info['pk']
-        data = await request.json()
+        data = await request.json(loads=general.json_loads)
         symbol = await request.bot.dbclient.get_order_by_pk(int(pk))
         if symbol:
             await symbol.update_from_dict(data)
             await symbol.save()
+            self._responses.invalidate(request.stock_name, 'symbols')
         else:
             symbol = {}
-        return web.json_response({
+        return json_response({
             'data': await symbol.to_dict(),
         })
 
@@ -102,47 +186,55 @@ class RestServer:
                 await request.bot.delete_all_orders()
             else:
                 await request.bot.delete_order(int(order_pk))
-            return web.json_response({})
+            return json_response({})
         elif obj == 'button':
             button_pk = request.match_info['id']
             button = await request.bot.dbclient.delete_button(int(button_pk))
-            return web.json_response({'ok': 1})
+            self._responses.invalidate(request.stock_name, 'buttons')
+            return json_response({'ok': 1})
         else:
             raise web_exceptions.HTTPNotFound(reason='Unknown object')
 
 
+    async def build_symbols(self, bot):
+        symbols = (await bot.dbclient.list_symbols()).filter(
+            second__in=bot._stock_config['FILTER_QUOTES']
+        )
+        data = []
+        async for symbol in symbols:
+            data.append(await symbol.to_dict())
+        return {
+            'data': data
+        }
+
+
+    async def build_buttons(self, bot):
+        buttons = await bot.dbclient.list_buttons()
+        data = []
+        async for button in buttons:
+            data.append(await button.to_dict())
+        return {
+            'data': data
+        }
+
+
     async def list_handler(self, request):
         objects = request.match_info['objects']
         if objects == 'orders':
-            orders = await request.bot.dbclient.list_orders()
-            data = []
-            async for order in orders:
-                data.append(await order.to_dict())
-            data = {
-                'data': data
-            }
-        elif objects == 'symbols':
-            symbols = (await request.bot.dbclient.list_symbols()).filter(
-                second__in=request.bot._stock_config['FILTER_QUOTES']
+            return await stream_json_list(
+                request, 'data', request.bot.dbclient.iter_order_dicts()
             )
-            data = []
-            async for symbol in symbols:
-                data.append(await symbol.to_dict())
-            data = {
-                'data': data
-            }
+        elif objects == 'symbols':
+            build = self.build_symbols
         elif objects == 'buttons':
-            buttons = await request.bot.dbclient.list_buttons()
-            data = []
-            async for button in buttons:
-                data.append(await button.to_dict())
-            data = {
-                'data': data
-            }
+            build = self.build_buttons
         else:
             raise web_exceptions.HTTPNotFound(reason="Unknown object")
 
-        return web.json_response(data)
+        entry = await self._responses.get(
+            request.stock_name, objects, functools.partial(build, request.bot)
+        )
+        return self._responses.respond(request, entry)
 
 
     async def get_handler(self, request):
@@ -153,24 +245,27 @@ class RestServer:
             if not ticker:
                 raise ValueError('No params provided')
             try:
-                price = await request.bot.api.get_rate(ticker)
+                price = await request.bot.get_rate(ticker)
                 data = {'price': price}
             except KeyError:
                 data = {'error' : 'No such symbol'}
-        return web.json_response(data)
+        elif obj == 'stats':
+            data = request.bot.get_stats()
+            data['responses'] = self._responses.get_stats()
+        return json_response(data)
 
 
     async def post_handler(self, request):
         obj = request.match_info['object']
         if obj == 'order':
-            data = await request.json()
+            data = await request.json(loads=general.json_loads)
             first, second = data['symbol'].split('/')
             if request.stock_name == 'bitmax' and second != 'USDT':
                 raise self.NotUSDTError(data['symbol'])
 
             trigger_price = float(data['trigger_price'])
             price = float(data['price'])
-            order_type = data['order_type']
+            order_type = int(data['order_type'])
             symbol = await request.bot.dbclient.get_symbol(first, second)
             volume = float(data['volume'])
             volume /= price
@@ -184,10 +279,10 @@ class RestServer:
                 volume=volume
             )
 
-            return web.json_response(await order.to_dict())
+            return json_response(await order.to_dict())
 
         elif obj == 'button':
-            button = await request.json()
+            button = await request.json(loads=general.json_loads)
 
             order_type = int(button['order_type'])
             volume = float(button['volume'])
@@ -196,64 +291,170 @@ class RestServer:
                 order_type=order_type,
                 volume=volume
             )
+            self._responses.invalidate(request.stock_name, 'buttons')
 
-            return web.json_response({'ok': 1})
+            return json_response({'ok': 1})
 
         else:
             raise web_exceptions.HTTPNotFound(reason="Unknown object")
 
 
     async def download_db(self, request):
-        orders = await (await request.bot.dbclient.list_orders())
-        data = {'orders':[]}
+        # One order per line, written chunk by chunk as the DB pages them
+        response = await prepare_ndjson(request, headers={
+            'Content-Disposition': 'Attachment;filename=db.dump',
+        })
+        async for chunk in request.bot.dbclient.iter_order_dicts():
+            await write_ndjson(response, chunk)
+        await response.write_eof()
+        return response
 
-        for order in orders:
-            order = await order.to_dict()
-            data['orders'].append(order)
 
-        data = json.dumps(data)
-
-        response = web.Response(
-            body=data,
-            headers={
-                'Content-Disposition': 'Attachment;filename=db.dump',
-            },
-        )
-
-        return response
+    async def parse_dump_order(self, request, record):
+        first, second = record['symbol'].split('/')
+        symbol = await request.bot.dbclient.get_symbol(first, second)
+        return {
+            'symbol': symbol,
+            'order_type': int(record['order_type']),
+            'trigger_price': float(record['trigger_price']),
+            'price': float(record['price']),
+            'volume': float(record['volume']),
+        }
+
+
+    async def import_dump_batch(self, request, response, batch, lines):
+        try:
+            orders = await request.bot.add_orders(batch)
+        except Exception as exc:
+            logger.exception(exc)
+            await write_ndjson(response, [
+                {'lines': [lines[0], lines[-1]], 'error': str(exc)},
+            ])
+            return 0
+        await write_ndjson(response, [
+            {'line': lines[-1], 'imported': len(orders)},
+        ])
+        return len(orders)
 
 
     async def upload_db(self, request):
+        # Orders are read line by line and added IMPORT_BATCH at a time, one
+        # transaction per batch. Progress and rejected lines are streamed
+        # back as NDJSON, the last line is the summary
         reader = await request.multipart()
         while True:
             part = await reader.next()
             if not part:
-                break
+                raise web_exceptions.HTTPBadRequest()
             if part.name == 'file':
-                if not part.filename:
-                    raise web_exceptions.HTTPBadRequest()
-                data = json.loads(await part.text())
-                for order in data['orders']:
-                    first, second = order['symbol'].split('/')
-                    symbol = await request.bot.dbclient.get_symbol(first, second)
-
-                    trigger_price = float(order['trigger_price'])
-                    price = float(order['price'])
-                    order_type = int(order['order_type'])
-                    volume = float(order['volume'])
-
-                    try:
-                        order = await request.bot.dbclient.add_order(
-                            symbol=symbol,
-                            order_type=order_type,
-                            trigger_price=trigger_price,
-                            price=price,
-                            volume=volume
-                        )
-                    except Exception as exc:
-                        logger.exception(exc)
-                        raise exc
-        return web.Response(text='response')
+                break
+        if not part.filename:
+            raise web_exceptions.HTTPBadRequest()
+
+        response = await prepare_ndjson(request)
+        imported = 0
+        errors = 0
+        batch = []
+        lines = []
+        async for number, record in iter_dump_records(part):
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                batch.append(await self.parse_dump_order(request, record))
+                lines.append(number)
+            except Exception as exc:
+                errors += 1
+                await write_ndjson(response, [
+                    {'line': number, 'error': f'{type(exc).__name__}: {exc}'},
+                ])
+                continue
+            if len(batch) >= IMPORT_BATCH:
+                added = await self.import_dump_batch(
+                    request, response, batch, lines
+                )
+                imported += added
+                errors += len(batch) - added
+                batch = []
+                lines = []
+        if batch:
+            added = await self.import_dump_batch(request, response, batch, lines)
+            imported += added
+            errors += len(batch) - added
+        await write_ndjson(response, [
+            {'done': True, 'imported': imported, 'errors': errors},
+        ])
+        await response.write_eof()
+        return response
+
+
+    async def send_events(self, ws, client):
+        # A send that cannot finish in time means the client stopped reading
+        while True:
+            batch = await client.get()
+            if batch is None:
+                break
+            try:
+                await asyncio.wait_for(
+                    ws.send_str(general.json_dumps(batch)), PUSH_SEND_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                client.close('slow consumer')
+                break
+            except ConnectionResetError:
+                # Nothing left to close
+                client.close('connection reset')
+                return None
+        await ws.close(message=client.closed.encode('utf-8'))
+
+
+    async def stream_handler(self, request):
+        # Server push of prices, order and processing events. Clients send
+        # {"op": "subscribe" | "unsubscribe", "tickers": [...]}, the price
+        # interval is taken from the query and is at least PUSH_INTERVAL
+        interval = request.query.get('interval')
+        if interval:
+            try:
+                interval = float(interval)
+            except ValueError:
+                interval = math.nan
+            if not interval > 0 or math.isinf(interval):
+                raise web_exceptions.HTTPBadRequest(reason='Invalid interval')
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        events = request.bot.events
+        dbclient = request.bot.dbclient
+        client = events.connect(interval or None)
+        sender = asyncio.create_task(self.send_events(ws, client))
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    data = general.json_loads(msg.data)
+                    tickers = data['tickers']
+                    if not isinstance(tickers, list) or not all(
+                        isinstance(ticker, str) for ticker in tickers
+                    ):
+                        raise TypeError('tickers must be a list of strings')
+                    if data['op'] == 'subscribe':
+                        # Unknown tickers would open stream subscriptions
+                        for ticker in tickers:
+                            await dbclient.get_symbol_by_ticker(ticker)
+                        await events.subscribe(client, tickers)
+                    elif data['op'] == 'unsubscribe':
+                        await events.unsubscribe(client, tickers)
+                    else:
+                        raise ValueError(data['op'])
+                except (
+                    ValueError, KeyError, TypeError, dbclient.NoSymbolExists
+                ) as exc:
+                    client.push({'type': 'error', 'data': repr(exc)})
+        finally:
+            if not client.closed:
+                client.close('closed')
+            await events.disconnect(client)
+            sender.cancel()
+        return ws
 
 
     def set_views(self):
@@ -262,6 +463,7 @@ class RestServer:
             web.get(self._prefix + '/get/{object}', self.get_handler),
             web.get(self._prefix + '/user/info', self.get_user_info),
             web.get(self._prefix + '/download/db', self.download_db),
+            web.get(self._prefix + '/stream', self.stream_handler),
             web.post(self._prefix + '/post/{object}', self.post_handler),
             web.post(self._prefix + '/update/symbol/{pk}', self.update_symbol_handler),
             web.post(self._prefix + '/update/symbols', self.update_symbols_handler),
@@ -34,12 +34,12 @@ class AbstractBot(ABC):
 
 
     @abstractmethod
-    async def damp(self, order, p_order, damping_left):
+    async def add_orders(self, rows):
         pass
 
 
     @abstractmethod
-    async def place_order(self, order, p_order, ot='limit', damp_count=None):
+    async def place_order(self, order, p_order, ot='limit', template=None):
         pass
 
 
@@ -48,11 +48,21 @@ class AbstractBot(ABC):
         pass
 
 
+    @abstractmethod
+    async def get_rate(self, ticker):
+        pass
+
+
     @abstractmethod
     async def get_orders_for_rate(self, rate):
         pass
 
 
+    @abstractmethod
+    def get_stats(self):
+        pass
+
+
     @abstractmethod
     async def handle_data(self):
         pass
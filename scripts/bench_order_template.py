@@ -0,0 +1,100 @@
+# Microbenchmark of the order placement fast path: the time from a
+# triggered order to the request body and headers ready to be written.
+# Network time is not included. Run with python -m scripts.bench_order_template
+import base64
+import datetime
+import hashlib
+import hmac
+import timeit
+from urllib.parse import urlencode
+
+import general
+from api import binance_api, bitmax_api
+
+BINANCE_SECRET = 'x' * 64
+BITMAX_SECRET = base64.b64encode(b'x' * 32).decode('utf-8')
+NUMBER = 20000
+
+
+def binance_from_scratch():
+    timestamp = str(int(datetime.datetime.now().timestamp() * 1000))
+    params = {
+        'symbol': 'BTCUSDT',
+        'quantity': '0.001',
+        'type': 'LIMIT',
+        'side': 'BUY',
+        'timeInForce': 'GTC',
+        'price': '9300.0',
+        'timestamp': timestamp,
+    }
+    key = BINANCE_SECRET.encode('utf-8')
+    signature = hmac.new(key, urlencode(params).encode('utf-8'), hashlib.sha256)
+    params['signature'] = signature.hexdigest()
+    return urlencode(params)
+
+
+def bitmax_from_scratch():
+    timestamp = int(datetime.datetime.now().timestamp() * 1000)
+    data = {
+        'time': timestamp,
+        'symbol': 'BTC/USDT',
+        'orderQty': '0.001',
+        'orderType': 'limit',
+        'side': 'buy',
+        'respInst': 'ACK',
+        'orderPrice': '9300.0',
+    }
+    timestamp = int(datetime.datetime.now().timestamp() * 1000)
+    msg = f'{timestamp}+order'.encode('utf-8')
+    signature = hmac.new(base64.b64decode(BITMAX_SECRET), msg, hashlib.sha256)
+    headers = {
+        'x-auth-timestamp': str(timestamp),
+        'x-auth-signature': base64.b64encode(signature.digest()).decode('utf-8'),
+    }
+    return headers, general.json_dumps(data)
+
+
+def main():
+    binance_template = binance_api.OrderTemplate(
+        'https://api.binance.com/api/v3/order',
+        urlencode({
+            'symbol': 'BTCUSDT',
+            'quantity': '0.001',
+            'type': 'LIMIT',
+            'side': 'BUY',
+            'timeInForce': 'GTC',
+            'price': '9300.0',
+        }),
+        'LIMIT',
+        binance_api.Util.get_hmac(BINANCE_SECRET),
+    )
+    bitmax_template = bitmax_api.OrderTemplate(
+        'https://bitmax.io/0/api/pro/v1/cash/order',
+        {
+            'symbol': 'BTC/USDT',
+            'orderQty': '0.001',
+            'orderType': 'limit',
+            'side': 'buy',
+            'respInst': 'ACK',
+            'orderPrice': '9300.0',
+        },
+        'limit',
+        bitmax_api.Util.get_hmac(BITMAX_SECRET),
+    )
+    cases = [
+        ('binance from scratch', binance_from_scratch),
+        ('binance template', lambda: binance_template.render(
+            binance_api.Util.get_timestamp()
+        )),
+        ('bitmax from scratch', bitmax_from_scratch),
+        ('bitmax template', lambda: bitmax_template.render(
+            bitmax_api.Util.get_timestamp()
+        )),
+    ]
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=NUMBER, repeat=5))
+        print(f'{name:<24} {seconds / NUMBER * 1e6:8.2f} us')
+
+
+if __name__ == '__main__':
+    main()
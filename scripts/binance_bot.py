@@ -1,10 +1,17 @@
 from .abstract_bot import AbstractBot
+from .event_hub import EventHub
+from .order_lanes import OrderLanes
+from .price_cache import PriceCache
+from .retry_scheduler import RetryScheduler
 from api.sms_api import SMSApi
-from api.binance_api import BinanceREST_API
+from api.binance_api import BinanceREST_API, BinanceWebSocket
+from api.default_api import LatestMailbox, DispatchEngine
 from db.db_client import BinanceDBClient
 from db.models import OrderType, Status, ProcessingOrder
 
+import aiohttp
 import asyncio
+import collections
 import logging
 import pprint
 
@@ -17,6 +24,32 @@ class BinanceBot(AbstractBot):
         self._logger = logging.getLogger(f'{logger_name}.binance_bot')
         self._sms_config = sms_config
         self._subscribed_channels = {}
+        self._tick_stats = collections.Counter()
+        self._rate_mailbox = LatestMailbox(self.process_rate, self._logger)
+        self._price_cache = PriceCache(
+            self.fetch_rate, ttl=self._stock_config.get('PRICE_TTL', 10)
+        )
+        self.events = EventHub(
+            get_price=self._price_cache.get_fresh,
+            watch=self.subscribe_to_symbol,
+            unwatch=self.unsubscribe_from_symbol,
+            interval=self._stock_config.get('PUSH_INTERVAL', 1),
+            max_pending=self._stock_config.get('PUSH_MAX_PENDING', 256),
+            max_tickers=self._stock_config.get('PUSH_MAX_TICKERS', 64),
+        )
+        self._order_templates = {}
+        # processing pk: (order, p_order) of triggered orders being placed
+        self._placing = {}
+        self._order_lanes = OrderLanes(
+            self._logger, self._stock_config.get('ORDER_CONCURRENCY', 8)
+        )
+        self._retries = RetryScheduler(
+            self._logger,
+            base_delay=self._stock_config.get('RETRY_BASE_DELAY', 0.5),
+            max_delay=self._stock_config.get('RETRY_MAX_DELAY', 10),
+            max_retries=self._stock_config.get('DAMP_COUNT', 5),
+            deadline=self._stock_config.get('RETRY_DEADLINE', 30),
+        )
 
     async def __aenter__(self):
         self._tasks = asyncio.Queue()
@@ -33,7 +66,18 @@ class BinanceBot(AbstractBot):
 
         await self.api.__aenter__()
 
-        self.ws = await self.api.connect_ws()
+        self.ws = await self.api.connect_ws(
+            connection_num=self._stock_config.get('WS_CONNECTIONS', 1),
+            max_streams=self._stock_config.get(
+                'WS_MAX_STREAMS', BinanceWebSocket.MAX_STREAMS
+            ),
+            dispatch_workers=self._stock_config.get('DISPATCH_WORKERS', 2),
+            dispatch_queue_size=self._stock_config.get('DISPATCH_QUEUE_SIZE', 1024),
+            dispatch_policy=self._stock_config.get(
+                'DISPATCH_POLICY', DispatchEngine.DROP_BY_KEY
+            ),
+            dispatch_key=lambda msg: msg.get('stream'),
+        )
         # self.order_ws = await self.api.connect_to_orders_ws()
         await self.ws.__aenter__()
         # await self.order_ws.__aenter__()
@@ -42,6 +86,7 @@ class BinanceBot(AbstractBot):
         await self.dbclient.__aenter__()
 
     async def __aexit__(self, *args, **kwargs):
+        await self._order_lanes.stop()
         await self.sms.__aexit__(*args, **kwargs)
         await self.ws.__aexit__(*args, **kwargs)
         # await self.order_ws.__aexit__(*args, **kwargs)
@@ -55,122 +100,321 @@ class BinanceBot(AbstractBot):
         return await self._tasks.get()
 
 
-    async def add_order(self, symbol, *args, **kwargs):
-        channel = f'{symbol.ticker.lower()}@ticker'
-        await self.ws.subscribe_to_channel(channel)
+    def get_channel(self, ticker):
+        price_source = self._stock_config.get('PRICE_SOURCE', 'bookTicker')
+        return f'{ticker.lower()}@{price_source}'
+
+
+    async def subscribe_to_symbol(self, ticker):
+        channel = self.get_channel(ticker)
         channel_num = self._subscribed_channels.get(channel, 0) + 1
         self._subscribed_channels[channel] = channel_num
-        # print(self._subscribed_channels)
+        if channel_num == 1:
+            await self.ws.subscribe_to_channel(channel)
+
+
+    async def unsubscribe_from_symbol(self, ticker):
+        await self.unsubscribe_from_symbols([ticker])
+
+
+    async def unsubscribe_from_symbols(self, tickers):
+        # Channels that lose their last order go out in one message
+        channels = []
+        for ticker in tickers:
+            channel = self.get_channel(ticker)
+            if channel not in self._subscribed_channels:
+                continue
+            if self._subscribed_channels[channel] == 1:
+                del self._subscribed_channels[channel]
+                channels.append(channel)
+            else:
+                self._subscribed_channels[channel] -= 1
+        if channels:
+            await self.ws.unsubscribe_from_channels(channels)
+
+
+    def build_template(self, order, ot='LIMIT'):
+        order_side = 'BUY' if order.order_type == OrderType.BUY else 'SELL'
+        return self.api.prepare_order(
+            symbol=order.symbol.ticker,
+            price=order.price,
+            size=order.volume,
+            order_type=ot,
+            order_side=order_side,
+        )
+
+
+    def prepare_order(self, order, ot='LIMIT'):
+        # Templates are kept for armed orders only, a triggered order takes
+        # its template along so a new order reusing the pk can't replace it
+        template = self.build_template(order, ot)
+        self._order_templates[order.pk] = template
+        return template
+
+
+    async def add_order(self, symbol, *args, **kwargs):
         order = await self.dbclient.add_order(symbol, *args, **kwargs)
+        await self.subscribe_to_symbol(symbol.ticker)
+        self.prepare_order(order)
+        if self.events.has_clients():
+            self.events.publish('orders_added', [await order.to_dict()])
         return order
 
 
+    async def add_orders(self, rows):
+        orders = await self.dbclient.add_orders(rows)
+        if self.events.has_clients():
+            self.events.publish(
+                'orders_added', [await order.to_dict() for order in orders]
+            )
+        for order in orders:
+            await self.subscribe_to_symbol(order.symbol.ticker)
+            self.prepare_order(order)
+        return orders
+
+
     async def delete_all_orders(self):
-        channels = list(map(str.lower, self._subscribed_channels.keys()))
-        await self.ws.unsubscribe_from_channels(list(channels))
+        for p_order_pk in list(self._placing):
+            self.cancel_placing(p_order_pk)
+        channels = list(self._subscribed_channels.keys())
+        await self.ws.unsubscribe_from_channels(channels)
         self._subscribed_channels.clear()
-        await (await self.dbclient.list_orders()).delete()
+        self._order_templates.clear()
+        await self.dbclient.delete_all_orders()
+        self.events.publish('orders_deleted', 'all')
+        # Tickers pushed to clients keep their streams
+        for ticker in self.events.get_tickers():
+            await self.subscribe_to_symbol(ticker)
+
+
+    def find_placing(self, order_pk):
+        for p_order_pk, (order, p_order) in self._placing.items():
+            if order.pk == order_pk:
+                return p_order_pk
+        return None
+
+
+    def cancel_placing(self, p_order_pk):
+        # place_order drops a job whose processing pk is no longer placing
+        order, p_order = self._placing.pop(p_order_pk)
+        self._retries.cancel(p_order_pk)
+        self.dbclient.delete_processing(p_order)
+        return order
 
 
     async def delete_order(self, order_pk):
+        # Order pks are reused, an armed order wins over a triggered one
+        # that is still being placed under the same pk
+        if not self.dbclient.is_order_armed(order_pk):
+            p_order_pk = self.find_placing(order_pk)
+            if p_order_pk is not None:
+                self.cancel_placing(p_order_pk)
+                self.events.publish('orders_deleted', [order_pk])
+                return None
         order = await self.dbclient.delete_order(order_pk)
+        self.events.publish('orders_deleted', [order_pk])
+        self._order_templates.pop(order.pk, None)
         ticker = (await order.symbol).ticker
-        channel = f'{ticker.lower()}@ticker'
-        if channel in self._subscribed_channels:
-            if self._subscribed_channels[channel] == 1:
-                del self._subscribed_channels[channel]
-                await self.ws.unsubscribe_from_channels([channel])
-            else:
-                self._subscribed_channels[channel] -= 1
+        await self.unsubscribe_from_symbol(ticker)
 
 
-    async def damp(self, order, p_order, damping_left):
-        self._logger.debug(f'damping {damping_left}')
-        if damping_left == 0:
-            return None
-        await self.place_order(
+    def retry_order(self, order, p_order, ot, template, reason):
+        scheduled = self._retries.schedule(
+            p_order.pk,
+            reason,
+            self._order_lanes.submit,
+            order.symbol.ticker,
+            self.place_order,
             order=order,
             p_order=p_order,
-            damp_count=(damping_left - 1)
+            ot=ot,
+            template=template,
         )
+        if scheduled:
+            self._logger.info(
+                f'Retrying order {order.pk} as {p_order.pk} ({reason})'
+            )
+        return scheduled
 
-    async def place_order(self, order, p_order, ot='LIMIT', damp_count=None):
-        if not damp_count:
-            damp_count = self._stock_config['DAMP_COUNT']
-        status = Status.PROCESSING
-        symbol = order.symbol
-        order_side = 'BUY' if order.order_type == OrderType.BUY else 'SELL'
-        result = await self.api.place_order(
-            symbol=symbol.ticker,
-            price=order.price,
-            size=order.volume,
-            order_type=ot,
-            order_side=order_side,
-        )
+
+    def publish_processing(self, order, p_order, status, **data):
+        self.events.publish('processing', {
+            'id': p_order.pk,
+            'order': order.pk,
+            'status': status,
+            **data,
+        })
+
+
+    async def place_order(self, order, p_order, ot='LIMIT', template=None):
+        if p_order.pk not in self._placing:
+            self._logger.info(f'Dropped order {order.pk}, it was deleted')
+            return None
+        if not template or template.order_type != ot:
+            template = self.build_template(order, ot)
+        try:
+            result = await self.api.place_prepared_order(template)
+        except aiohttp.ClientConnectorError as exc:
+            # The request never reached the exchange, so it is safe to retry
+            self._logger.warning(f'Placing order {order.pk} failed: {exc!r}')
+            result = {'code': type(exc).__name__}
+            retryable = True
+        else:
+            retryable = result.get('code') in self._stock_config['DAMPING_CODES']
         self._logger.info('Placed order')
         self._logger.info(result)
         self._logger.info(await p_order.to_str())
-        if result['code'] in self._stock_config['DAMPING_CODES']:
-            if self._stock_config['DAMPING']:
-                await asyncio.sleep(0.5)
-                asyncio.create_task(self.damp(
-                    order=order,
-                    p_order=p_order,
-                    damping_left=damp_count,
-                ))
-        elif result['code'] == 0:
-            order_id = result['data']['orderId']
-            p_order.order_id = order_id
-            await p_order.save()
+        # Binance only sends a code with errors
+        code = result.get('code')
+        if p_order.pk not in self._placing:
+            # Deleted while the request was in flight, an order the exchange
+            # took is live there, so it is kept instead of being lost
+            if code is None:
+                order_id = str(result['orderId'])
+                self._logger.warning(
+                    f'Order {order.pk} was deleted while being placed, '
+                    f'the exchange accepted it as {order_id}'
+                )
+                self.dbclient.restore_processing(p_order)
+                self.dbclient.save_order_id(p_order, order_id)
+                self.publish_processing(
+                    order, p_order, 'placed', order_id=order_id
+                )
+                return result
+            self._logger.info(
+                f'Order {order.pk} was deleted while being placed: {result}'
+            )
+            return None
+        if code is None:
+            del self._placing[p_order.pk]
+            self._retries.finish(p_order.pk, 'placed')
+            self.dbclient.save_order_id(p_order, str(result['orderId']))
+            self.publish_processing(
+                order, p_order, 'placed', order_id=str(result['orderId'])
+            )
             return result
+        elif retryable and self._stock_config['DAMPING']:
+            if self.retry_order(order, p_order, ot, template, code):
+                self.publish_processing(order, p_order, 'retrying', reason=code)
+                return None
         else:
-            await p_order.delete()
+            self._retries.finish(p_order.pk, 'rejected')
+        del self._placing[p_order.pk]
+        self.dbclient.delete_processing(p_order)
+        self.publish_processing(order, p_order, 'failed', reason=code)
+
 
     async def update_symbols(self):
-        products = self.api.get_all_products()
-        products = [product async for product in products]
-        await self.dbclient.add_symbols(products)
-        return products
+        result = await self.dbclient.add_symbols(self.api.get_all_products())
+        await self.rename_symbols(result['renames'])
+        return result
 
-    async def get_orders_for_rate(self, price, symbol):
+
+    async def rename_symbols(self, renames):
+        # Armed orders of a renamed symbol move to the new ticker's stream
+        # and get their templates rebuilt with it
+        if not renames:
+            return None
+        tickers = {new for old, new in renames}
+        async for order in await self.dbclient.list_orders():
+            if order.symbol.ticker in tickers:
+                self.prepare_order(order)
+        old_channels = []
+        for old, new in renames:
+            old_channel = self.get_channel(old)
+            new_channel = self.get_channel(new)
+            if old_channel == new_channel or old_channel not in self._subscribed_channels:
+                continue
+            channel_num = self._subscribed_channels.pop(old_channel)
+            self._subscribed_channels[new_channel] = (
+                self._subscribed_channels.get(new_channel, 0) + channel_num
+            )
+            if self._subscribed_channels[new_channel] == channel_num:
+                await self.ws.subscribe_to_channel(new_channel)
+            old_channels.append(old_channel)
+        if old_channels:
+            await self.ws.unsubscribe_from_channels(old_channels)
+
+
+    async def fetch_rate(self, ticker):
+        return await self.api.get_mid_price(ticker)
+
+
+    async def get_rate(self, ticker):
+        # Served from the stream fed cache, REST only for cold tickers
+        return await self._price_cache.get(ticker)
+
+    async def get_orders_for_rate(self, bid, ask, symbol):
+        if not self.dbclient.is_armed(symbol):
+            return None
         try:
             symbol = await self.dbclient.get_symbol_by_ticker(symbol)
         except self.dbclient.NoSymbolExists as exc:
             return None
 
+        # BUY triggers are checked against the best ask, SELL against the best bid
         bid_orders, ask_orders = await asyncio.gather(
-            self.dbclient.get_orders_for_price_bid(price, symbol),
-            self.dbclient.get_orders_for_price_ask(price, symbol)
+            self.dbclient.get_orders_for_price_bid(ask, symbol),
+            self.dbclient.get_orders_for_price_ask(bid, symbol)
         )
 
         return bid_orders, ask_orders, symbol
 
+    async def process_rate(self, symbol, prices):
+        bid, ask = prices
+        orders = await self.get_orders_for_rate(bid, ask, symbol)
+
+        if not orders:
+            return None
+
+        bid_orders, ask_orders, symbol = orders
+        await self.place_triggered(bid_orders + ask_orders)
+
+
+    async def place_triggered(self, orders):
+        # All orders of a tick move to processing in one transaction
+        processing = await self.dbclient.make_processing_many(orders)
+        self.events.publish('orders_triggered', [
+            {'order': order.pk, 'processing': p_order.pk}
+            for order, p_order in processing
+        ])
+        for order, p_order in processing:
+            self._placing[p_order.pk] = (order, p_order)
+            self._order_lanes.submit(
+                order.symbol.ticker,
+                self.place_order,
+                order=order,
+                p_order=p_order,
+                template=self._order_templates.pop(order.pk, None),
+            )
+        # Websocket pacing may sleep, so streams are dropped only after
+        # every order is on its way
+        await self.unsubscribe_from_symbols(
+            [order.symbol.ticker for order, p_order in processing]
+        )
+
+
     async def handle_data(self):
-        @self.ws.add_dispatcher(name='rate_handler')
+        price_source = self._stock_config.get('PRICE_SOURCE', 'bookTicker')
+
+        @self.ws.add_dispatcher(name='rate_handler', key=price_source)
         async def handle_rate(msg):
-            if 'stream' in msg:
-                price = float(msg['data']['c'])
-                symbol = msg['stream'].split('@')[0].upper()
-                orders = await self.get_orders_for_rate(price, symbol)
-
-                if not orders:
-                    return None
-
-                bid_orders, ask_orders, symbol = orders
-                if bid_orders:
-                    async for order in bid_orders:
-                        p_order = await self.dbclient.make_processing(order, None)
-                        result = await self.place_order(
-                            order=order,
-                            p_order=p_order,
-                        )
-                if ask_orders:
-                    async for order in ask_orders:
-                        p_order = await self.dbclient.make_processing(order, None)
-                        result = await self.place_order(
-                            order=order,
-                            p_order=p_order,
-                        )
+            data = msg['data']
+            if price_source == 'bookTicker':
+                bid = float(data['b'])
+                ask = float(data['a'])
+            else:
+                bid = ask = float(data['c'])
+            symbol = msg['stream'].split('@')[0].upper()
+            # Both streams carry the best bid and ask, prices are midpoints
+            price = (float(data['b']) + float(data['a'])) / 2
+            self._price_cache.put(symbol, price)
+            self.events.publish_price(symbol, price)
+            self._tick_stats['received'] += 1
+            if not self.dbclient.is_crossed(symbol, bid, ask):
+                self._tick_stats['filtered'] += 1
+                return None
+            self._rate_mailbox.put(symbol, (bid, ask))
         while True:
             try:
                 await self.ws.handle_messages()
@@ -180,6 +424,21 @@ class BinanceBot(AbstractBot):
                 await self.subscribe_to_existing_orders()
 
 
+    def get_stats(self):
+        return {
+            'ticks': dict(self._tick_stats),
+            'rate_mailbox': self._rate_mailbox.get_stats(),
+            'dispatch': self.ws.get_stats(),
+            'order_lanes': self._order_lanes.get_stats(),
+            'price_cache': self._price_cache.get_stats(),
+            'events': self.events.get_stats(),
+            'rate_governor': self.api.governor.get_stats(),
+            'retries': self._retries.get_stats(),
+            'db': self.dbclient.get_stats(),
+            'http_pool': self.api.connection_pool.get_stats(),
+        }
+
+
     async def handle_order_updates(self):
         @self.order_ws.add_dispatcher('orders_handler')
         async def handler(msg):
@@ -209,10 +468,10 @@ class BinanceBot(AbstractBot):
     async def setup(self):
         existing_orders = await self.dbclient.list_orders()
         async for order in existing_orders:
-            ticker = order.symbol.ticker.lower()
-            channel = f'{ticker}@ticker'
+            channel = self.get_channel(order.symbol.ticker)
             num = self._subscribed_channels.get(channel, 0) + 1
             self._subscribed_channels[channel] = num
+            self.prepare_order(order)
         await self.subscribe_to_existing_orders()
 
 
@@ -222,6 +481,7 @@ class BinanceBot(AbstractBot):
         try:
             tasks = asyncio.gather(*[
                 self.handle_data(),
+                self._retries.run(),
                 # self.handle_order_updates(),
             ])
             await tasks
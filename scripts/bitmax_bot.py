@@ -1,12 +1,20 @@
 import logging
 
+import aiohttp
 import asyncio
+import collections
+import time
 
-from api.bitmax_api import BitmaxREST_API
+from api.bitmax_api import BitmaxREST_API, Util
+from api.default_api import LatestMailbox, DispatchEngine
 from api.sms_api import SMSApi
 from db.db_client import BitmaxDBClient
 from db.models import OrderType
 from .abstract_bot import AbstractBot
+from .event_hub import EventHub
+from .order_lanes import OrderLanes
+from .price_cache import PriceCache
+from .retry_scheduler import RetryScheduler
 
 
 class BitmaxBot(AbstractBot):
@@ -18,6 +26,34 @@ class BitmaxBot(AbstractBot):
         self._stock_config = stock_config
         self._logger = logging.getLogger(f'{logger_name}.bitmax_bot')
         self._sms_config = sms_config
+        self._tick_stats = collections.Counter()
+        self._subscribed_channels = {}
+        self._stream_updates = {}
+        self._price_mailbox = LatestMailbox(self.process_price, self._logger)
+        self._price_cache = PriceCache(
+            self.fetch_rate, ttl=self._stock_config.get('PRICE_TTL', 10)
+        )
+        self.events = EventHub(
+            get_price=self._price_cache.get_fresh,
+            watch=self.subscribe_to_symbol,
+            unwatch=self.unsubscribe_from_symbol,
+            interval=self._stock_config.get('PUSH_INTERVAL', 1),
+            max_pending=self._stock_config.get('PUSH_MAX_PENDING', 256),
+            max_tickers=self._stock_config.get('PUSH_MAX_TICKERS', 64),
+        )
+        self._order_templates = {}
+        # processing pk: (order, p_order) of triggered orders being placed
+        self._placing = {}
+        self._order_lanes = OrderLanes(
+            self._logger, self._stock_config.get('ORDER_CONCURRENCY', 8)
+        )
+        self._retries = RetryScheduler(
+            self._logger,
+            base_delay=self._stock_config.get('RETRY_BASE_DELAY', 0.5),
+            max_delay=self._stock_config.get('RETRY_MAX_DELAY', 10),
+            max_retries=self._stock_config.get('DAMP_COUNT', 5),
+            deadline=self._stock_config.get('RETRY_DEADLINE', 30),
+        )
 
 
     async def __aenter__(self):
@@ -35,7 +71,17 @@ class BitmaxBot(AbstractBot):
 
         await self.api.__aenter__()
 
-        self.ws = await self.api.connect_ws()
+        self.ws = await self.api.connect_ws(
+            dispatch_workers=self._stock_config.get('DISPATCH_WORKERS', 2),
+            dispatch_queue_size=self._stock_config.get('DISPATCH_QUEUE_SIZE', 1024),
+            dispatch_policy=self._stock_config.get(
+                'DISPATCH_POLICY', DispatchEngine.BLOCK
+            ),
+            # Only market data may be replaced, order updates are never keyed
+            dispatch_key=lambda msg: (
+                msg.get('symbol') if msg.get('m') in ('bbo', 'trades') else None
+            ),
+        )
         await self.ws.__aenter__()
 
         await self.sms.__aenter__()
@@ -43,6 +89,7 @@ class BitmaxBot(AbstractBot):
 
 
     async def __aexit__(self, *args, **kwargs):
+        await self._order_lanes.stop()
         await self.sms.__aexit__(*args, **kwargs)
         await self.ws.__aexit__(*args, **kwargs)
         await self.api.__aexit__(*args, **kwargs)
@@ -57,34 +104,38 @@ class BitmaxBot(AbstractBot):
         return await self._tasks.get()
 
 
-    async def add_order(self, symbol, *args, **kwargs):
-        return await self.dbclient.add_order(symbol, *args, **kwargs)
+    def get_price_source(self):
+        return self._stock_config.get('PRICE_SOURCE', 'bbo')
 
 
-    async def delete_all_orders(self):
-        await (await self.dbclient.list_orders()).delete()
+    def get_channel(self, ticker):
+        return f'{self.get_price_source()}:{ticker}'
 
 
-    async def delete_order(self, order_pk):
-        await self.dbclient.delete_order(order_pk)
+    async def subscribe_to_symbol(self, ticker):
+        channel = self.get_channel(ticker)
+        channel_num = self._subscribed_channels.get(channel, 0) + 1
+        self._subscribed_channels[channel] = channel_num
+        if channel_num == 1:
+            self._stream_updates[ticker] = time.monotonic()
+            await self.ws.subscribe_to_channel(channel)
 
 
-    async def damp(self, order, p_order, damping_left):
-        self._logger.debug(f'damping {damping_left}')
-        if damping_left == 0:
-            return None
-        await self.place_order(
-            order=order,
-            p_order=p_order,
-            damp_count=(damping_left - 1)
-        )
+    async def unsubscribe_from_symbol(self, ticker):
+        channel = self.get_channel(ticker)
+        if channel in self._subscribed_channels:
+            if self._subscribed_channels[channel] == 1:
+                del self._subscribed_channels[channel]
+                self._stream_updates.pop(ticker, None)
+                await self.ws.unsubscribe_from_channel(channel)
+            else:
+                self._subscribed_channels[channel] -= 1
 
 
-    async def place_order(self, order, p_order, ot='limit', damp_count=None):
-        symbol = str(await order.symbol)
+    async def build_template(self, order, ot='limit'):
         order_side = 'buy' if order.order_type == OrderType.BUY else 'sell'
-        result = await self.api.place_order(
-            symbol=symbol,
+        return await self.api.prepare_order(
+            symbol=order.symbol.ticker,
             price=order.price,
             size=order.volume,
             order_type=ot,
@@ -92,34 +143,224 @@ class BitmaxBot(AbstractBot):
             post_only=False,
             resp_inst='ACK'
         )
+
+
+    async def prepare_order(self, order, ot='limit'):
+        # Templates are kept for armed orders only, a triggered order takes
+        # its template along so a new order reusing the pk can't replace it
+        template = await self.build_template(order, ot)
+        self._order_templates[order.pk] = template
+        return template
+
+
+    async def add_order(self, symbol, *args, **kwargs):
+        order = await self.dbclient.add_order(symbol, *args, **kwargs)
+        await self.subscribe_to_symbol(symbol.ticker)
+        await self.prepare_order(order)
+        if self.events.has_clients():
+            self.events.publish('orders_added', [await order.to_dict()])
+        return order
+
+
+    async def add_orders(self, rows):
+        orders = await self.dbclient.add_orders(rows)
+        if self.events.has_clients():
+            self.events.publish(
+                'orders_added', [await order.to_dict() for order in orders]
+            )
+        for order in orders:
+            await self.subscribe_to_symbol(order.symbol.ticker)
+            await self.prepare_order(order)
+        return orders
+
+
+    async def delete_all_orders(self):
+        for p_order_pk in list(self._placing):
+            self.cancel_placing(p_order_pk)
+        for channel in self._subscribed_channels:
+            await self.ws.unsubscribe_from_channel(channel)
+        self._subscribed_channels.clear()
+        self._stream_updates.clear()
+        self._order_templates.clear()
+        await self.dbclient.delete_all_orders()
+        self.events.publish('orders_deleted', 'all')
+        # Tickers pushed to clients keep their streams
+        for ticker in self.events.get_tickers():
+            await self.subscribe_to_symbol(ticker)
+
+
+    def find_placing(self, order_pk):
+        for p_order_pk, (order, p_order) in self._placing.items():
+            if order.pk == order_pk:
+                return p_order_pk
+        return None
+
+
+    def cancel_placing(self, p_order_pk):
+        # place_order drops a job whose processing pk is no longer placing
+        order, p_order = self._placing.pop(p_order_pk)
+        self._retries.cancel(p_order_pk)
+        self.dbclient.delete_processing(p_order)
+        return order
+
+
+    async def delete_order(self, order_pk):
+        # Order pks are reused, an armed order wins over a triggered one
+        # that is still being placed under the same pk
+        if not self.dbclient.is_order_armed(order_pk):
+            p_order_pk = self.find_placing(order_pk)
+            if p_order_pk is not None:
+                self.cancel_placing(p_order_pk)
+                self.events.publish('orders_deleted', [order_pk])
+                return None
+        order = await self.dbclient.delete_order(order_pk)
+        self.events.publish('orders_deleted', [order_pk])
+        self._order_templates.pop(order.pk, None)
+        await self.unsubscribe_from_symbol((await order.symbol).ticker)
+
+
+    def retry_order(self, order, p_order, ot, template, reason):
+        scheduled = self._retries.schedule(
+            p_order.pk,
+            reason,
+            self._order_lanes.submit,
+            order.symbol.ticker,
+            self.place_order,
+            order=order,
+            p_order=p_order,
+            ot=ot,
+            template=template,
+        )
+        if scheduled:
+            self._logger.info(
+                f'Retrying order {order.pk} as {p_order.pk} ({reason})'
+            )
+        return scheduled
+
+
+    def publish_processing(self, order, p_order, status, **data):
+        self.events.publish('processing', {
+            'id': p_order.pk,
+            'order': order.pk,
+            'status': status,
+            **data,
+        })
+
+
+    async def place_order(self, order, p_order, ot='limit', template=None):
+        if p_order.pk not in self._placing:
+            self._logger.info(f'Dropped order {order.pk}, it was deleted')
+            return None
+        if not template or template.order_type != ot:
+            template = await self.build_template(order, ot)
+        try:
+            result = await self.api.place_prepared_order(template)
+        except aiohttp.ClientConnectorError as exc:
+            # The request never reached the exchange, so it is safe to retry
+            self._logger.warning(f'Placing order {order.pk} failed: {exc!r}')
+            result = {'code': type(exc).__name__}
+            retryable = True
+        else:
+            retryable = result['code'] in self._stock_config['DAMPING_CODES']
         self._logger.info(f'Placed order\n{result}\n')
-        if result['code'] in self._stock_config['DAMPING_CODES']:
-            if self._stock_config['DAMPING']:
-                await asyncio.sleep(0.5)
-                asyncio.create_task(self.damp(
-                    order=order,
-                    p_order=p_order,
-                    damping_left=damp_count,
-                ))
-        elif result['code'] == 0:
+        if p_order.pk not in self._placing:
+            # Deleted while the request was in flight, an order the exchange
+            # took is live there, so it is kept instead of being lost
+            if result['code'] == 0:
+                order_id = result['data']['info']['orderId']
+                self._logger.warning(
+                    f'Order {order.pk} was deleted while being placed, '
+                    f'the exchange accepted it as {order_id}'
+                )
+                self.dbclient.restore_processing(p_order)
+                self.dbclient.save_order_id(p_order, order_id)
+                self.publish_processing(
+                    order, p_order, 'placed', order_id=order_id
+                )
+                return result
+            self._logger.info(
+                f'Order {order.pk} was deleted while being placed: {result}'
+            )
+            return None
+        if result['code'] == 0:
+            del self._placing[p_order.pk]
+            self._retries.finish(p_order.pk, 'placed')
             order_id = result['data']['info']['orderId']
-            p_order.order_id = order_id
-            await p_order.save()
+            self.dbclient.save_order_id(p_order, order_id)
+            self.publish_processing(order, p_order, 'placed', order_id=order_id)
             return result
+        elif retryable and self._stock_config['DAMPING']:
+            if self.retry_order(order, p_order, ot, template, result['code']):
+                self.publish_processing(
+                    order, p_order, 'retrying', reason=result['code']
+                )
+                return None
         else:
-            await p_order.delete()
+            self._retries.finish(p_order.pk, 'rejected')
+        del self._placing[p_order.pk]
+        self.dbclient.delete_processing(p_order)
+        self.publish_processing(order, p_order, 'failed', reason=result['code'])
 
 
     async def update_symbols(self):
-        products = self.api.get_all_products()
-        products = [product async for product in products]
-        await self.dbclient.add_symbols(products)
-        return products
+        result = await self.dbclient.add_symbols(self.api.get_all_products())
+        await self.rename_symbols(result['renames'])
+        return result
+
+
+    async def rename_symbols(self, renames):
+        # Armed orders of a renamed symbol move to the new ticker's stream
+        # and get their templates rebuilt with it
+        if not renames:
+            return None
+        tickers = {new for old, new in renames}
+        async for order in await self.dbclient.list_orders():
+            if order.symbol.ticker in tickers:
+                await self.prepare_order(order)
+        for old, new in renames:
+            old_channel = self.get_channel(old)
+            new_channel = self.get_channel(new)
+            if old_channel == new_channel or old_channel not in self._subscribed_channels:
+                continue
+            channel_num = self._subscribed_channels.pop(old_channel)
+            self._stream_updates.pop(old, None)
+            self._subscribed_channels[new_channel] = (
+                self._subscribed_channels.get(new_channel, 0) + channel_num
+            )
+            if self._subscribed_channels[new_channel] == channel_num:
+                self._stream_updates[new] = time.monotonic()
+                await self.ws.subscribe_to_channel(new_channel)
+            await self.ws.unsubscribe_from_channel(old_channel)
+
+
+    async def fetch_rate(self, ticker):
+        return await self.api.get_mid_price(ticker)
+
+
+    async def get_rate(self, ticker):
+        # Served from the stream fed cache, REST only for cold tickers
+        return await self._price_cache.get(ticker)
+
+
+    def parse_rate(self, rate):
+        # /ticker rows carry [price, size] of the best bid and ask next to
+        # the last price, the bid/ask pair is used with the bbo source
+        if self.get_price_source() == 'bbo' and rate.get('bid') and rate.get('ask'):
+            bid = float(rate['bid'][0])
+            ask = float(rate['ask'][0])
+        else:
+            bid = ask = float(rate['close'])
+        return {
+            'symbol': rate['symbol'],
+            'bid': bid,
+            'ask': ask,
+        }
 
 
     async def get_orders_for_rate(self, rate):
         symbol = rate['symbol']
-        price = float(rate['close'])
+        bid = rate['bid']
+        ask = rate['ask']
 
         try:
             if '/' not in symbol:
@@ -129,71 +370,179 @@ class BitmaxBot(AbstractBot):
         except self.dbclient.NoSymbolExists:
             return None
 
+        # BUY triggers are checked against the best ask, SELL against the best bid
         bid_orders, ask_orders = await asyncio.gather(
-            self.dbclient.get_orders_for_price_bid(price, symbol),
-            self.dbclient.get_orders_for_price_ask(price, symbol)
+            self.dbclient.get_orders_for_price_bid(ask, symbol),
+            self.dbclient.get_orders_for_price_ask(bid, symbol)
         )
 
         return bid_orders, ask_orders, symbol
 
 
+    async def trigger_orders(self, rate):
+        orders = await self.get_orders_for_rate(rate)
+        if not orders:
+            return None
+        bid_orders, ask_orders, symbol = orders
+        await self.place_triggered(bid_orders + ask_orders)
+
+
+    async def place_triggered(self, orders):
+        # All orders of a tick move to processing in one transaction
+        processing = await self.dbclient.make_processing_many(orders)
+        self.events.publish('orders_triggered', [
+            {'order': order.pk, 'processing': p_order.pk}
+            for order, p_order in processing
+        ])
+        for order, p_order in processing:
+            self._placing[p_order.pk] = (order, p_order)
+            self._order_lanes.submit(
+                order.symbol.ticker,
+                self.place_order,
+                order=order,
+                p_order=p_order,
+                template=self._order_templates.pop(order.pk, None),
+                ot='limit',
+            )
+        # Websocket sends may wait, so streams are dropped only after every
+        # order is on its way
+        for order, p_order in processing:
+            await self.unsubscribe_from_symbol(order.symbol.ticker)
+
+
+    def handle_price(self, ticker, bid, ask, quote=True):
+        # Prices are midpoints of the best bid and ask, trades only drive
+        # the triggers
+        if ticker in self._stream_updates:
+            self._stream_updates[ticker] = time.monotonic()
+        if quote:
+            price = (bid + ask) / 2
+            self._price_cache.put(ticker, price)
+            self.events.publish_price(ticker, price)
+        self._tick_stats['received'] += 1
+        if not self.dbclient.is_crossed(ticker, bid, ask):
+            self._tick_stats['filtered'] += 1
+            return None
+        self._price_mailbox.put(ticker, (bid, ask))
+
+
+    async def process_price(self, ticker, prices):
+        bid, ask = prices
+        await self.trigger_orders({
+            'symbol': ticker,
+            'bid': bid,
+            'ask': ask,
+        })
+
+
+    def get_stale_tickers(self):
+        timeout = self._stock_config.get('STREAM_STALE_TIMEOUT', 5)
+        now = time.monotonic()
+        return {
+            ticker for ticker, updated in self._stream_updates.items()
+            if now - updated > timeout
+        }
+
+
     async def handle_rate(self):
+        # Triggers are driven by the websocket stream, /ticker is only
+        # polled for symbols whose stream went quiet
         while True:
+            await asyncio.sleep(0.5)
+            stale = self.get_stale_tickers()
+            if not stale:
+                continue
             result = await self.api.get('/ticker')
             data = result.get('data')
             if not data:
                 self._logger.error(result)
                 continue
-            for symbol in data:
+            # The poll returns every ticker, all of them refresh the cache
+            for rate in data:
+                price = Util.get_mid_price(rate)
+                self._price_cache.put(rate['symbol'], price)
+                self.events.publish_price(rate['symbol'], price)
+            data = [
+                self.parse_rate(rate) for rate in data if rate['symbol'] in stale
+            ]
+            crossed = self.dbclient.get_crossed_tickers(
+                (rate['symbol'], rate['bid'], rate['ask']) for rate in data
+            )
+            self._tick_stats['received'] += len(data)
+            self._tick_stats['filtered'] += len(data) - len(crossed)
+            self._tick_stats['polled'] += len(data)
+            # Orders of every crossed symbol are triggered as one batch
+            triggered = []
+            for rate in data:
+                if rate['symbol'] not in crossed:
+                    continue
                 try:
-                    orders = await self.get_orders_for_rate(symbol)
-                    if not orders:
-                        continue
-                    bid_orders, ask_orders, symbol = orders
-
-                    if bid_orders:
-                        async for order in bid_orders:
-                            p_order = await self.dbclient.make_processing(order, None)
-                            result = await self.place_order(
-                                order=order,
-                                p_order=p_order,
-                                ot='limit',
-                            )
-                    if ask_orders:
-                        async for order in ask_orders:
-                            p_order = await self.dbclient.make_processing(order, None)
-                            result = await self.place_order(
-                                order=order,
-                                p_order=p_order,
-                                ot='limit',
-                            )
+                    orders = await self.get_orders_for_rate(rate)
                 except Exception as exc:
                     self._logger.exception(exc)
                     continue
-            await asyncio.sleep(0.5)
+                if orders:
+                    bid_orders, ask_orders, symbol = orders
+                    triggered += bid_orders + ask_orders
+            if triggered:
+                try:
+                    await self.place_triggered(triggered)
+                except Exception as exc:
+                    self._logger.exception(exc)
+
+
+    def get_stats(self):
+        return {
+            'ticks': dict(self._tick_stats),
+            'price_mailbox': self._price_mailbox.get_stats(),
+            'dispatch': self.ws.get_stats(),
+            'order_lanes': self._order_lanes.get_stats(),
+            'price_cache': self._price_cache.get_stats(),
+            'events': self.events.get_stats(),
+            'rate_governor': self.api.governor.get_stats(),
+            'retries': self._retries.get_stats(),
+            'db': self.dbclient.get_stats(),
+            'http_pool': self.api.connection_pool.get_stats(),
+        }
 
 
     async def handle_data(self):
-        @self.ws.add_dispatcher(name='receiver')
+        @self.ws.add_dispatcher(name='receiver', key='order')
         async def handler(msg):
-            if msg['m'] == 'order':
-                try:
-                    status = msg['data']['st']
-                    if status in ('Filled', 'PartiallyFilled'):
-                        raw = f'Ордер на бирже Bitmax сработал'
-                        if self._sms_config['ON']:
-                            await self.sms.send_sms([self._sms_config['PHONE']], raw)
-                    elif status != 'New':
-                        self._logger.info(status)
-                except Exception as exc:
-                    self._logger.exception(exc)
-                    raise exc
+            try:
+                status = msg['data']['st']
+                self.events.publish('exchange_order', {
+                    'order_id': msg['data'].get('orderId'),
+                    'status': status,
+                })
+                if status in ('Filled', 'PartiallyFilled'):
+                    raw = f'Ордер на бирже Bitmax сработал'
+                    if self._sms_config['ON']:
+                        await self.sms.send_sms([self._sms_config['PHONE']], raw)
+                elif status != 'New':
+                    self._logger.info(status)
+            except Exception as exc:
+                self._logger.exception(exc)
+                raise exc
+
+        @self.ws.add_dispatcher(name='bbo', key='bbo')
+        async def handle_bbo(msg):
+            bid = float(msg['data']['bid'][0])
+            ask = float(msg['data']['ask'][0])
+            self.handle_price(msg['symbol'], bid, ask)
+
+        @self.ws.add_dispatcher(name='trades', key='trades')
+        async def handle_trades(msg):
+            price = float(msg['data'][-1]['p'])
+            self.handle_price(msg['symbol'], price, price, quote=False)
 
         while True:
             try:
                 await self.ws.handle_messages()
             except self.ws.WSClosed as exc:
+                self._logger.warning(f'WS closed in handle_data')
                 await self.ws.__aenter__()
+                await self.subscribe_to_existing_orders()
                 continue
 
 
@@ -206,14 +555,32 @@ class BitmaxBot(AbstractBot):
             await self.ws.send_json_with_op(op=op, data=data)
 
 
-    async def run(self):
-        self._logger.debug('Started')
+    async def subscribe_to_existing_orders(self):
         await self.ws.subscribe_to_channel(
             f'order:cash', id='abc')
+        for channel in self._subscribed_channels:
+            await self.ws.subscribe_to_channel(channel)
+
+
+    async def setup(self):
+        existing_orders = await self.dbclient.list_orders()
+        async for order in existing_orders:
+            channel = self.get_channel(order.symbol.ticker)
+            num = self._subscribed_channels.get(channel, 0) + 1
+            self._subscribed_channels[channel] = num
+            self._stream_updates[order.symbol.ticker] = time.monotonic()
+            await self.prepare_order(order)
+        await self.subscribe_to_existing_orders()
+
+
+    async def run(self):
+        self._logger.debug('Started')
+        await self.setup()
         self.tasks = asyncio.gather(*[
             self.handle_data(),
             self.handle_rate(),
             self.send_from_queue(),
+            self._retries.run(),
         ])
         result = await self.tasks
         self._logger.error(result)
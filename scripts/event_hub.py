@@ -0,0 +1,177 @@
+import asyncio
+import collections
+import time
+
+
+class HubClient:
+    # Events wait in a bounded deque, prices only keep the latest value per
+    # ticker and go out at most once per interval. A client whose deque
+    # fills up is closed as a slow consumer.
+
+    def __init__(self, interval, max_pending):
+        self.interval = interval
+        self.tickers = set()
+        self.closed = None
+        self._max_pending = max_pending
+        self._events = collections.deque()
+        self._prices = {}
+        self._prices_sent = 0
+        self._wakeup = asyncio.Event()
+
+
+    def push(self, event):
+        if self.closed:
+            return None
+        if len(self._events) >= self._max_pending:
+            self.close('slow consumer')
+            return None
+        self._events.append(event)
+        self._wakeup.set()
+
+
+    def push_price(self, ticker, price):
+        # Only the first pending price wakes the sender, later ones
+        # overwrite it until the interval is up
+        if not self._prices:
+            self._wakeup.set()
+        self._prices[ticker] = price
+
+
+    def close(self, reason):
+        self.closed = reason
+        self._wakeup.set()
+
+
+    async def get(self):
+        # Next batch of messages to send, None once the client is closed
+        while not self.closed:
+            batch = list(self._events)
+            self._events.clear()
+            wait = None
+            if self._prices:
+                now = time.monotonic()
+                wait = self._prices_sent + self.interval - now
+                if wait <= 0:
+                    batch.append({'type': 'prices', 'data': self._prices})
+                    self._prices = {}
+                    self._prices_sent = now
+                    wait = None
+            if batch:
+                return batch
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+        return None
+
+
+class EventHub:
+    # Fans out what the bot already has in memory to the connected clients:
+    # prices of the tickers each client subscribed to and order events.
+    # get_price gives the current price a new subscriber starts with,
+    # watch/unwatch are awaited when a ticker gets its first subscriber
+    # and loses its last one. Every ticker costs a stream subscription, a
+    # client can't hold more than max_tickers.
+
+    def __init__(
+        self,
+        get_price=None,
+        watch=None,
+        unwatch=None,
+        interval=1,
+        max_pending=256,
+        max_tickers=64,
+    ):
+        self._get_price = get_price
+        self._watch = watch
+        self._unwatch = unwatch
+        self._interval = interval
+        self._max_pending = max_pending
+        self._max_tickers = max_tickers
+        self._clients = set()
+        self._price_clients = {}
+        self._stats = collections.Counter()
+
+
+    def has_clients(self):
+        return bool(self._clients)
+
+
+    def get_tickers(self):
+        return list(self._price_clients)
+
+
+    def connect(self, interval=None):
+        # Clients may ask for a slower price interval, never a faster one
+        interval = max(self._interval, interval or 0)
+        client = HubClient(interval, self._max_pending)
+        self._clients.add(client)
+        self._stats['connected'] += 1
+        return client
+
+
+    async def disconnect(self, client):
+        if client not in self._clients:
+            return None
+        self._clients.discard(client)
+        await self.unsubscribe(client, list(client.tickers))
+        if client.closed == 'slow consumer':
+            self._stats['slow_consumers'] += 1
+        self._stats['disconnected'] += 1
+
+
+    async def subscribe(self, client, tickers):
+        new = set(tickers) - client.tickers
+        if len(client.tickers) + len(new) > self._max_tickers:
+            raise ValueError(f'At most {self._max_tickers} tickers per client')
+        for ticker in tickers:
+            if ticker in client.tickers:
+                continue
+            client.tickers.add(ticker)
+            clients = self._price_clients.setdefault(ticker, set())
+            clients.add(client)
+            if len(clients) == 1 and self._watch:
+                await self._watch(ticker)
+            price = self._get_price(ticker) if self._get_price else None
+            if price is not None:
+                client.push_price(ticker, price)
+
+
+    async def unsubscribe(self, client, tickers):
+        for ticker in tickers:
+            if ticker not in client.tickers:
+                continue
+            client.tickers.discard(ticker)
+            clients = self._price_clients[ticker]
+            clients.discard(client)
+            if not clients:
+                del self._price_clients[ticker]
+                if self._unwatch:
+                    await self._unwatch(ticker)
+
+
+    def publish(self, kind, data):
+        if not self._clients:
+            return None
+        event = {'type': kind, 'data': data}
+        for client in self._clients:
+            client.push(event)
+        self._stats[f'events_{kind}'] += 1
+
+
+    def publish_price(self, ticker, price):
+        # Called on every tick, a ticker nobody watches costs one lookup
+        clients = self._price_clients.get(ticker)
+        if not clients:
+            return None
+        for client in clients:
+            client.push_price(ticker, price)
+
+
+    def get_stats(self):
+        return {
+            'clients': len(self._clients),
+            'tickers': len(self._price_clients),
+            **self._stats,
+        }
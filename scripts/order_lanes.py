@@ -0,0 +1,70 @@
+import asyncio
+import collections
+import time
+
+
+class OrderLanes:
+    # One FIFO lane per symbol, each drained by its own task. Jobs of one
+    # symbol run strictly in submission order, lanes of different symbols
+    # run concurrently and at most `concurrency` jobs run at once overall.
+    # A lane task exits as soon as its lane is empty.
+
+    def __init__(self, logger, concurrency=8):
+        self._logger = logger
+        self._concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._lanes = {}
+        self._workers = {}
+        self._running = 0
+        self._stats = collections.Counter()
+        self._wait_max = 0.0
+
+
+    def submit(self, key, func, *args, **kwargs):
+        lane = self._lanes.setdefault(key, collections.deque())
+        lane.append((func, args, kwargs, time.monotonic()))
+        self._stats['submitted'] += 1
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._run_lane(key, lane))
+
+
+    async def _run_lane(self, key, lane):
+        try:
+            while lane:
+                func, args, kwargs, submitted = lane.popleft()
+                async with self._semaphore:
+                    self._wait_max = max(self._wait_max, time.monotonic() - submitted)
+                    self._running += 1
+                    try:
+                        await func(*args, **kwargs)
+                    except Exception as exc:
+                        self._stats['errors'] += 1
+                        self._logger.exception(exc)
+                    finally:
+                        self._running -= 1
+                self._stats['completed'] += 1
+        finally:
+            del self._workers[key]
+            if not lane:
+                del self._lanes[key]
+
+
+    async def stop(self):
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._lanes.clear()
+
+
+    def get_stats(self):
+        return {
+            'lanes': len(self._workers),
+            'pending': sum(len(lane) for lane in self._lanes.values()),
+            'running': self._running,
+            'concurrency': self._concurrency,
+            'submitted': self._stats['submitted'],
+            'completed': self._stats['completed'],
+            'errors': self._stats['errors'],
+            'wait_max': self._wait_max,
+        }
@@ -0,0 +1,71 @@
+import asyncio
+import collections
+import time
+
+
+class PriceCache:
+    # Last price and update time per ticker, fed by the price streams the
+    # bot already reads. Prices are midpoints of the best bid and ask, the
+    # streams, polls and fetch(ticker) all report that. A ticker with no
+    # price newer than ttl seconds is fetched with fetch(ticker), concurrent
+    # gets of one ticker share a single in-flight fetch. Failed fetches are
+    # not cached.
+
+    def __init__(self, fetch, ttl=10):
+        self._fetch = fetch
+        self._ttl = ttl
+        self._prices = {}
+        self._inflight = {}
+        self._stats = collections.Counter()
+
+
+    def put(self, ticker, price):
+        self._prices[ticker] = (price, time.monotonic())
+
+
+    def get_fresh(self, ticker):
+        entry = self._prices.get(ticker)
+        if entry and time.monotonic() - entry[1] <= self._ttl:
+            return entry[0]
+        return None
+
+
+    async def _fetch_price(self, ticker):
+        try:
+            price = float(await self._fetch(ticker))
+            self.put(ticker, price)
+            return price
+        except Exception:
+            self._stats['fetch_errors'] += 1
+            raise
+        finally:
+            del self._inflight[ticker]
+
+
+    async def get(self, ticker):
+        price = self.get_fresh(ticker)
+        if price is not None:
+            self._stats['hits'] += 1
+            return price
+        future = self._inflight.get(ticker)
+        if future is None:
+            self._stats['fetches'] += 1
+            future = self._inflight[ticker] = asyncio.ensure_future(
+                self._fetch_price(ticker)
+            )
+        else:
+            self._stats['joined'] += 1
+        # A cancelled caller must not cancel the fetch the others wait for
+        return await asyncio.shield(future)
+
+
+    def get_stats(self):
+        now = time.monotonic()
+        return {
+            'tickers': len(self._prices),
+            'fresh': sum(
+                1 for _, updated in self._prices.values() if now - updated <= self._ttl
+            ),
+            'inflight': len(self._inflight),
+            **self._stats,
+        }
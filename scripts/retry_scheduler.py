@@ -0,0 +1,156 @@
+import asyncio
+import collections
+import heapq
+import random
+import time
+
+
+class RetryEntry:
+
+    def __init__(self, key):
+        self.key = key
+        self.callback = None
+        self.args = ()
+        self.kwargs = {}
+        self.attempts = 0
+        self.started = time.monotonic()
+        self.due = None
+        self.finished = None
+        self.outcome = 'pending'
+        self.reasons = []
+
+
+    def to_dict(self):
+        return {
+            'attempts': self.attempts,
+            'outcome': self.outcome,
+            'reasons': self.reasons,
+            'elapsed': round((self.finished or time.monotonic()) - self.started, 3),
+        }
+
+
+class RetryScheduler:
+    # Pending retries sit in a heap ordered by due time and a single timer
+    # task hands each one to its callback when it is due. The callback only
+    # submits work, so nothing in the placing path ever sleeps. Delays grow
+    # exponentially with jitter, an entry gives up after max_retries
+    # attempts or when the next attempt would fall past its deadline.
+
+    HISTORY_SIZE = 256
+
+    def __init__(
+        self,
+        logger,
+        base_delay=0.5,
+        max_delay=10,
+        max_retries=5,
+        deadline=30,
+        jitter=0.5,
+    ):
+        self._logger = logger
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._max_retries = max_retries
+        self._deadline = deadline
+        self._jitter = jitter
+        self._heap = []
+        self._seq = 0
+        self._entries = {}
+        self._history = collections.OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._stats = collections.Counter()
+
+
+    def get_delay(self, attempts):
+        delay = min(self._max_delay, self._base_delay * 2 ** (attempts - 1))
+        return delay * (1 - self._jitter * random.random())
+
+
+    def schedule(self, key, reason, callback, *args, **kwargs):
+        # Returns False when the entry is out of retries, past its deadline
+        # or was cancelled, the caller then owns the final outcome
+        entry = self._entries.get(key)
+        if entry is None:
+            cancelled = self._history.get(key)
+            if cancelled and cancelled.outcome == 'cancelled':
+                return False
+            entry = self._entries[key] = RetryEntry(key)
+        entry.reasons.append(reason)
+        if entry.attempts >= self._max_retries:
+            self.finish(key, 'exhausted')
+            return False
+        due = time.monotonic() + self.get_delay(entry.attempts + 1)
+        if due - entry.started > self._deadline:
+            self.finish(key, 'expired')
+            return False
+        entry.attempts += 1
+        entry.callback = callback
+        entry.args = args
+        entry.kwargs = kwargs
+        entry.due = due
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, entry))
+        self._stats['scheduled'] += 1
+        self._wakeup.set()
+        return True
+
+
+    def finish(self, key, outcome):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        entry.outcome = outcome
+        entry.due = None
+        entry.finished = time.monotonic()
+        self._stats[outcome] += 1
+        self._history[key] = entry
+        self._history.move_to_end(key)
+        while len(self._history) > self.HISTORY_SIZE:
+            self._history.popitem(last=False)
+        return entry
+
+
+    def cancel(self, key):
+        # Heap items of a finished entry are skipped when they come due
+        return self.finish(key, 'cancelled')
+
+
+    def cancel_all(self):
+        return [self.cancel(key) for key in list(self._entries)]
+
+
+    def _fire(self, entry):
+        try:
+            entry.callback(*entry.args, **entry.kwargs)
+        except Exception as exc:
+            self._logger.exception(exc)
+
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                due, _, entry = heapq.heappop(self._heap)
+                if entry.due != due or self._entries.get(entry.key) is not entry:
+                    continue
+                entry.due = None
+                self._stats['fired'] += 1
+                self._fire(entry)
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+    def get_stats(self):
+        orders = {key: entry.to_dict() for key, entry in self._history.items()}
+        orders.update(
+            (key, entry.to_dict()) for key, entry in self._entries.items()
+        )
+        return {
+            'pending': len(self._entries),
+            'orders': orders,
+            **self._stats,
+        }
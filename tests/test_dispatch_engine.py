@@ -0,0 +1,45 @@
+import asyncio
+import logging
+import unittest
+
+from api.default_api import DispatchEngine
+
+
+class DispatchEngineTest(unittest.TestCase):
+
+    def make_engine(self, maxsize):
+        async def handler(item):
+            pass
+        return DispatchEngine(
+            handler,
+            logging.getLogger('test'),
+            maxsize=maxsize,
+            policy=DispatchEngine.DROP_BY_KEY,
+            key=lambda item: item[0],
+        )
+
+
+    def test_drop_by_key_keeps_newest_after_overflow(self):
+        async def run():
+            engine = self.make_engine(maxsize=2)
+            for item in ('A1', 'B1', 'C1', 'A2'):
+                await engine.put(item)
+            return [item for _, item in engine._items], engine.get_stats()
+
+        items, stats = asyncio.run(run())
+        self.assertEqual(items, ['C1', 'A2'])
+        self.assertEqual(stats['dropped'], 2)
+
+
+    def test_drop_by_key_replaces_queued_item(self):
+        async def run():
+            engine = self.make_engine(maxsize=2)
+            for item in ('A1', 'B1', 'A2'):
+                await engine.put(item)
+            return [item for _, item in engine._items]
+
+        self.assertEqual(asyncio.run(run()), ['A2', 'B1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
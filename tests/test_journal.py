@@ -0,0 +1,128 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from tortoise import Tortoise
+
+import general
+from db.journal import WriteBehindJournal
+
+
+class WriteBehindJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'test.journal')
+        self.applied = []
+
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+
+    def make_journal(self):
+        async def handler(records, transaction):
+            for record in records:
+                if record == 'bad':
+                    raise ValueError(record)
+            self.applied.extend(records)
+        return WriteBehindJournal(self.path, 'default', handlers={'op': handler})
+
+
+    def write_lines(self, lines):
+        with open(self.path, 'w', encoding='utf-8') as file:
+            for line in lines:
+                file.write(general.json_dumps(line) + '\n')
+
+
+    def run_db(self, coroutine):
+        async def run():
+            await Tortoise.init(db_url='sqlite://:memory:', modules={'models': []})
+            try:
+                return await coroutine
+            finally:
+                await Tortoise.close_connections()
+        return asyncio.run(run())
+
+
+    def test_replay_applies_records_after_last_commit(self):
+        self.write_lines([
+            {'seq': 1, 'op': 'op', 'data': 1},
+            {'seq': 2, 'op': 'op', 'data': 2},
+            {'commit': 1},
+            {'seq': 3, 'op': 'op', 'data': 3},
+        ])
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write('{"seq": 4, "op"')
+
+        self.run_db(self.make_journal().replay())
+        self.assertEqual(self.applied, [2, 3])
+        self.assertFalse(os.path.exists(self.path))
+
+
+    def test_replay_keeps_records_that_fail(self):
+        self.write_lines([
+            {'seq': 1, 'op': 'op', 'data': 'bad'},
+            {'seq': 2, 'op': 'op', 'data': 2},
+        ])
+
+        self.run_db(self.make_journal().replay())
+        self.assertEqual(self.applied, [2])
+        with open(f'{self.path}.failed', encoding='utf-8') as file:
+            self.assertEqual(general.json_loads(file.read())['data'], 'bad')
+
+
+    def test_commit_truncates_journal(self):
+        async def run():
+            journal = self.make_journal()
+            await journal.__aenter__()
+            futures = [journal.append('op', data) for data in (1, 2)]
+            results = await asyncio.gather(*futures)
+            size = os.path.getsize(self.path)
+            await journal.__aexit__(None, None, None)
+            return results, size
+
+        results, size = self.run_db(run())
+        self.assertEqual(results, [True, True])
+        self.assertEqual(self.applied, [1, 2])
+        self.assertEqual(size, 0)
+
+
+    def test_failed_record_is_replayed_on_next_start(self):
+        async def run():
+            journal = self.make_journal()
+            await journal.__aenter__()
+            futures = [journal.append('op', data) for data in (1, 'bad', 3)]
+            results = await asyncio.gather(*futures)
+            await journal.__aexit__(None, None, None)
+            self.applied.clear()
+            await self.make_journal().replay()
+            return results
+
+        results = self.run_db(run())
+        self.assertEqual(results, [True, False, True])
+        # Handlers are idempotent, records after the failed one come again
+        self.assertEqual(self.applied, [3])
+
+
+    def test_writer_survives_failed_fsync(self):
+        async def run():
+            journal = self.make_journal()
+            await journal.__aenter__()
+            with mock.patch('db.journal.os.fsync', side_effect=OSError('EIO')):
+                failed = await journal.append('op', 1)
+            committed = await journal.append('op', 2)
+            stats = journal.get_stats()
+            await journal.__aexit__(None, None, None)
+            return failed, committed, stats
+
+        failed, committed, stats = self.run_db(run())
+        self.assertEqual((failed, committed), (False, True))
+        self.assertEqual(stats['failed_batches'], 1)
+        self.assertEqual(self.applied, [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
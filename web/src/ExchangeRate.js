@@ -1,5 +1,6 @@
 import React from 'react';
 import api from './server_api';
+import stream from './event_stream';
 import {BITMAX, BINANCE} from './config';
 
 export class ExchangeRate extends React.Component {
@@ -11,25 +12,30 @@ export class ExchangeRate extends React.Component {
         }
     }
 
-    fetch_rate () {
-        let ticker;
+    get_ticker () {
         if (window.stock === BITMAX) {
-            ticker = 'BTC/USDT';
+            return 'BTC/USDT';
         } else if (window.stock === BINANCE) {
-            ticker = 'BTCUSDT';
+            return 'BTCUSDT';
         }
+    }
+
+    set_rate (exchange_rate) {
+        this.setState({
+            exchange_rate: exchange_rate,
+            status: 'loaded',
+            timestamp: Date.now(),
+        });
+    }
+
+    fetch_rate () {
         api.api_method('/get/rate', {
             params: {
-                ticker: ticker,
+                ticker: this.get_ticker(),
             },
         }).then((
             (data) => {
-                let exchange_rate = data.price;
-                this.setState({
-                    exchange_rate: exchange_rate,
-                    status: 'loaded',
-                    timestamp: Date.now(),
-                });
+                this.set_rate(data.price);
             }
         ).bind(this)).catch((
             (error) => {
@@ -42,16 +48,23 @@ export class ExchangeRate extends React.Component {
     }
 
     componentDidMount () {
+        // Prices are pushed over the stream, /get/rate is only asked on
+        // mount and each time the stream drops or fails to reconnect
         this.fetch_rate();
-        this.timer = setInterval((
-            () => {
-                this.fetch_rate();
-            }
-        ).bind(this), 1000 * 30);
+        this.off_prices = stream.on('prices', ((prices) => {
+            let price = prices[this.get_ticker()];
+            if (price !== undefined) this.set_rate(price);
+        }).bind(this));
+        this.off_status = stream.on_status(((connected) => {
+            if (!connected) this.fetch_rate();
+        }).bind(this));
+        stream.watch(this.get_ticker());
     }
 
     componentWillUnmount () {
-        clearInterval(this.timer);
+        this.off_prices();
+        this.off_status();
+        stream.unwatch(this.get_ticker());
     }
 
     render () {
@@ -1,5 +1,6 @@
 import React from 'react';
 import api from './server_api';
+import stream from './event_stream';
 import { QuickButton } from './ButtonList';
 import { BUY, SELL, BITMAX, BINANCE} from './config';
 
@@ -72,7 +73,9 @@ class OrderList extends React.Component {
             sorted: false,
             orders: [],
         }
+    }
 
+    fetch_orders () {
         api.api_method('/list/orders').then((function (data) {
             let new_state = Object.assign({}, this.state);
             new_state = {
@@ -90,10 +93,41 @@ class OrderList extends React.Component {
         }).bind(this))
     }
 
+    remove_orders (ids) {
+        this.setState((state) => ({
+            orders: state.orders.filter((order) => !ids.includes(order.id)),
+        }));
+    }
+
     componentDidMount () {
+        // The list is kept current by stream events. Every open of the
+        // stream loads it to catch up on missed events, every failed
+        // (re)connect loads it as the polling fallback
+        if (stream.connected) this.fetch_orders();
+        this.off_stream = [
+            stream.on_status((() => this.fetch_orders()).bind(this)),
+            stream.on('orders_added', ((orders) => {
+                this.setState((state) => ({
+                    orders: state.orders.concat(orders.filter(
+                        (order) => !state.orders.some((known) => known.id === order.id)
+                    )),
+                }));
+            }).bind(this)),
+            stream.on('orders_deleted', ((ids) => {
+                if (ids === 'all') {
+                    this.setState({orders: []});
+                } else {
+                    this.remove_orders(ids);
+                }
+            }).bind(this)),
+            stream.on('orders_triggered', ((triggered) => {
+                this.remove_orders(triggered.map((item) => item.order));
+            }).bind(this)),
+        ];
     }
 
     componentWillUnmount(){
+        this.off_stream.forEach((off) => off());
     }
 
     render () {
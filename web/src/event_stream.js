@@ -0,0 +1,101 @@
+import {config, BITMAX, BINANCE} from './config';
+
+// One WebSocket to /stream per page, opened by the first listener.
+// Listeners get the data of the events of their type, tickers stay
+// subscribed while anyone watches them. A closed socket reconnects with
+// backoff, status listeners hear about every open and close so they can
+// fall back to the REST api while the stream is down.
+
+const RECONNECT_MIN = 1000;
+const RECONNECT_MAX = 30000;
+
+
+class EventStream {
+    constructor () {
+        this.socket = null;
+        this.connected = false;
+        this.delay = RECONNECT_MIN;
+        this.listeners = {};
+        this.status_listeners = new Set();
+        this.tickers = {};
+    }
+
+    get_url () {
+        let url = new URL(config.api_path + '/stream', config.api_url);
+        url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:';
+        switch (window.stock) {
+            case BITMAX:
+                url.searchParams.set('stock', 'bitmax');
+                break;
+            case BINANCE:
+                url.searchParams.set('stock', 'binance');
+                break;
+        }
+        return url.toString();
+    }
+
+    connect () {
+        if (this.socket) return;
+        let socket = new WebSocket(this.get_url());
+        this.socket = socket;
+        socket.onopen = () => {
+            this.delay = RECONNECT_MIN;
+            this.set_connected(true);
+            let tickers = Object.keys(this.tickers);
+            if (tickers.length) this.send('subscribe', tickers);
+        };
+        socket.onmessage = (message) => {
+            for (let event of JSON.parse(message.data)) {
+                let listeners = this.listeners[event.type];
+                if (listeners) listeners.forEach((listener) => listener(event.data));
+            }
+        };
+        socket.onclose = () => {
+            this.socket = null;
+            this.set_connected(false);
+            setTimeout(() => this.connect(), this.delay);
+            this.delay = Math.min(this.delay * 2, RECONNECT_MAX);
+        };
+    }
+
+    set_connected (connected) {
+        this.connected = connected;
+        this.status_listeners.forEach((listener) => listener(connected));
+    }
+
+    send (op, tickers) {
+        if (this.connected) {
+            this.socket.send(JSON.stringify({op: op, tickers: tickers}));
+        }
+    }
+
+    on (type, listener) {
+        if (!this.listeners[type]) this.listeners[type] = new Set();
+        this.listeners[type].add(listener);
+        this.connect();
+        return () => this.listeners[type].delete(listener);
+    }
+
+    on_status (listener) {
+        this.status_listeners.add(listener);
+        this.connect();
+        return () => this.status_listeners.delete(listener);
+    }
+
+    watch (ticker) {
+        this.tickers[ticker] = (this.tickers[ticker] || 0) + 1;
+        if (this.tickers[ticker] === 1) this.send('subscribe', [ticker]);
+    }
+
+    unwatch (ticker) {
+        if (!this.tickers[ticker]) return;
+        this.tickers[ticker] -= 1;
+        if (this.tickers[ticker] === 0) {
+            delete this.tickers[ticker];
+            this.send('unsubscribe', [ticker]);
+        }
+    }
+}
+
+const stream = new EventStream();
+export default stream;